@@ -8,16 +8,121 @@ import boto3
 import numpy as np
 import pandas as pd
 import xarray as xr
-import zarr
+from dask.utils import parse_bytes
+from s3fs import S3Map
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from src.util import stage_s3, open_zarr, get_config
+from src.chunk_copy import trim_leading_chunks
+from src.chunk_plan import config_chunks
+from src.codec_config import (
+    benchmark_codecs, build_encoding, empty_chunk_report, load_codec_config, precision_report, source_fill_values
+)
+from src.execution import add_execution_args, execution_context
+from src.rechunk import rechunk_to_zarr
+from src.s3_output import (
+    describe_store, output_store, output_url, store_snapshot, upload_store_changes, write_consolidated
+)
+from src.time_norm import KEEP_POLICIES, normalize_time
+from src.util import stage_s3, get_zarr_store, get_config, s3_client
 
 staging_dirs = []
 
 
+def append_in_place(ds: xr.Dataset, new_ds: xr.Dataset, store, remote: S3Map, config: dict, args,
+                    credentials) -> bool:
+    # Appends new_ds to the --zarr store without rewriting its existing chunks. A staged store only holds the metadata,
+    # coordinates and trailing partial time chunk; the append is written to it locally and only the changed objects
+    # are uploaded back to remote. A mounted store is remote itself and is written directly. Returns False, without
+    # writing anything, if new_ds cannot be appended in place.
+    dim = config['dimensions']['time']
+    time_coord = config['coordinates']['time']
+
+    if set(new_ds.data_vars) != set(ds.data_vars):
+        raise ValueError(f'Cannot append variables {sorted(new_ds.data_vars)} to a store with variables '
+                         f'{sorted(ds.data_vars)}')
+
+    for other_dim in (d for d in ds.dims if d != dim):
+        if other_dim in ds.coords and not np.array_equal(ds[other_dim].to_numpy(), new_ds[other_dim].to_numpy()):
+            print(f'Coordinate {other_dim} of new data does not match the existing store')
+            return False
+
+    # Only the existing time coordinate is read; no data variables are loaded
+    existing_times = ds[time_coord].to_numpy()
+
+    new_ds = normalize_time(new_ds, dim, time_coord, keep=args.keep)
+    duplicate = np.isin(new_ds[time_coord].to_numpy(), existing_times)
+
+    if duplicate.any() and args.keep == 'last':
+        print(f'{int(duplicate.sum()):,} new time steps replace existing ones; cannot append in place')
+        return False
+
+    if duplicate.any():
+        print(f'Warning: {int(duplicate.sum()):,} new time steps already exist in the store and will be dropped')
+        new_ds = new_ds.isel({dim: ~duplicate})
+
+    new_times = new_ds[time_coord].to_numpy()
+
+    if len(new_times) > 0 and new_times[0] <= existing_times[-1]:
+        print(f'New time steps start at {new_times[0]}, before the end of the existing store ({existing_times[-1]}); '
+              f'cannot append in place')
+        return False
+
+    if len(new_times) == 0:
+        print('No new time steps to append')
+        return True
+
+    print(f'Appending in place to {args.zarr}')
+
+    # Align dask chunks with the existing zarr chunk grid: the first chunk only fills the remainder of the existing
+    # partial time chunk (the only existing chunk that gets rewritten), every other chunk is a full zarr chunk
+    first_var = next(iter(ds.data_vars))
+    zarr_chunks = dict(zip(ds[first_var].dims, ds[first_var].encoding['chunks']))
+    time_chunk = zarr_chunks[dim]
+
+    n_new = new_ds.sizes[dim]
+    fill = min((time_chunk - ds.sizes[dim] % time_chunk) % time_chunk, n_new)
+    full, remainder = divmod(n_new - fill, time_chunk)
+    time_chunks = tuple(c for c in [fill] + [time_chunk] * full + [remainder] if c > 0)
+
+    chunk_config = {d: c for d, c in zarr_chunks.items() if d != dim}
+    chunk_config[dim] = time_chunks
+
+    print(f'Appending {n_new:,} time steps to {ds.sizes[dim]:,} existing steps with chunks {chunk_config}')
+
+    new_ds = new_ds.drop_vars([v for v in new_ds.variables if dim not in new_ds[v].dims])
+
+    for var in new_ds.data_vars:
+        new_ds[var] = new_ds[var].chunk(chunk_config)
+
+    before = store_snapshot(store) if isinstance(store, str) else None
+
+    write_consolidated(
+        new_ds,
+        store,
+        append_dim=dim,
+        write_empty_chunks=False
+    )
+
+    if before is not None:
+        upload_store_changes(store, before, args.zarr, credentials)
+
+    if args.duration is not None:
+        times = np.concatenate([existing_times, new_times]).astype('datetime64[ns]')
+        n_trim = int(np.searchsorted(times, times[-1] - np.timedelta64(args.duration.value, 'ns'), side='left'))
+
+        # Trimming is done in whole time chunks, so the store exceeds the max duration by less than one time chunk
+        if n_trim > 0:
+            trimmed = trim_leading_chunks(remote, dim, n_trim)
+            print(f'{n_trim:,} time steps exceed the max duration; trimmed {trimmed:,} (whole time chunks), the rest '
+                  f'are trimmed once they fill a time chunk')
+
+    empty_chunk_report(remote)
+
+    return True
+
+
 def main(args):
     pattern = args.pattern
     variables = args.variables
@@ -27,15 +132,39 @@ def main(args):
     dim = config['dimensions']['time']
 
     session = boto3.Session(profile_name=os.getenv('AWS_PROFILE', None))
-    client = session.client('s3')
+    client = s3_client(session)
+
+    store = None
+    in_place = False
 
     if args.zarr not in {'', 'none'}:
         credentials = session.get_credentials().get_frozen_credentials()
-        ds, stage_dir = open_zarr(args.zarr, args.zarr_access, client, credentials)
+
+        # Appending modifies the --zarr store itself, so the output has to name it
+        in_place = args.append and output_url(output, args.output_s3) == args.zarr.rstrip('/')
+
+        if args.append and not in_place:
+            print(f'--output-s3 and --output do not name {args.zarr}, so it cannot be appended to in place; '
+                  f'rewriting the full dataset instead')
+
+        # Appending in place needs every variable of the existing store, but only the chunks it rewrites
+        store, stage_dir = get_zarr_store(
+            args.zarr,
+            args.zarr_access,
+            client,
+            credentials,
+            variables=None if in_place else (variables or None),
+            tail=dim if in_place else None
+        )
 
         if stage_dir is not None:
             staging_dirs.append(stage_dir)
 
+        ds = xr.open_zarr(store, consolidated=True)
+
+        if variables and not in_place:
+            ds = ds[variables]
+
         print('Opened existing zarr dataset')
         print(ds)
     else:
@@ -62,8 +191,23 @@ def main(args):
 
     new_ds = new_ds[variables]
 
+    codecs = load_codec_config(config)
+
+    if args.benchmark_codecs:
+        benchmark_codecs(new_ds, codecs, config_chunks(config, new_ds, codecs))
+        return
+
+    if in_place:
+        remote = output_store(output, args.output_s3, credentials)
+
+        if not append_in_place(ds, new_ds, store, remote, config, args, credentials):
+            raise ValueError(f'New data cannot be appended to {args.zarr} in place; pass a different --output to '
+                             f'rewrite the full dataset there')
+
+        return
+
     if ds is not None:
-        ds = xr.concat((ds, new_ds), dim=dim).sortby(dim)
+        ds = xr.concat((ds, new_ds), dim=dim)
         print('Concatenated datasets')
         print(ds)
     else:
@@ -71,65 +215,42 @@ def main(args):
 
     time_coord = config['coordinates']['time']
 
-    # Dedup time steps
-
-    times = ds[time_coord].to_numpy()
+    ds = normalize_time(ds, dim, time_coord, keep=args.keep, duration=args.duration)
 
-    if any(np.diff(times).astype(int) == 0):
-        print(f'Warning: duplicate time steps detected')
+    chunk_config = config_chunks(config, ds, codecs)
 
-        prev = None
-        drop = []
-
-        for i, v in enumerate(times.astype(int)):
-            if v == prev:
-                drop.append(i - 1)
-
-            prev = v
-
-        print(f'Dropping {len(drop):,} time steps at indices: {drop}')
-
-        ds = ds.drop_duplicates(dim=dim, keep='first')
-
-    if args.duration is not None:
-        ds_duration = pd.Timedelta((ds[time_coord][-1] - ds[time_coord][0]).data.item())
-
-        print(f'new dataset duration: {ds_duration}')
-
-        if ds_duration > args.duration:
-            print('Dataset duration exceeds max duration provided')
-
-            idx = 0
-
-            while pd.Timedelta((ds[time_coord][-1] - ds[time_coord][idx]).data.item()) > args.duration:
-                idx += 1
-
-            ds = ds.isel(time=slice(idx, None))
+    # exit()
 
-            print(f'Dropped {idx:,} time steps. New dataset duration: '
-                  f'{pd.Timedelta((ds[time_coord][-1] - ds[time_coord][0]).data.item())}')
+    print(f'Setting chunk config: {chunk_config}')
 
-    chunk_config = {config['dimensions'][d]: config['chunks'][d] for d in config['chunks']}
+    encoding = build_encoding(codecs, ds, source_fill_values(ds))
 
-    # exit()
+    out_path = output_store(
+        output,
+        args.output_s3,
+        session.get_credentials().get_frozen_credentials() if args.output_s3 is not None else None
+    )
 
-    print(f'Setting chunk config: {chunk_config}')
+    print(f'Writing to zarr file: {describe_store(out_path)}')
 
-    for var in ds.data_vars:
-        ds[var] = ds[var].chunk(chunk_config)
+    if args.max_memory is not None:
+        rechunk_to_zarr(ds, chunk_config, out_path, encoding, args.max_memory, args.temp_dir)
+    else:
+        for var in ds.data_vars:
+            ds[var] = ds[var].chunk(chunk_config)
 
-    compressor = zarr.Blosc(cname="blosclz", clevel=9)
-    encoding = {vname: {'compressor': compressor} for vname in ds.data_vars}
+        write_consolidated(
+            ds,
+            out_path,
+            mode='w-',
+            encoding=encoding,
+            write_empty_chunks=False
+        )
 
-    print(f'Writing to zarr file: {os.path.join("output", output)}')
+    empty_chunk_report(out_path)
 
-    ds.to_zarr(
-        os.path.join('output', output),
-        mode='w-',
-        encoding=encoding,
-        consolidated=True,
-        write_empty_chunks=False
-    )
+    if len(codecs.precision) > 0:
+        precision_report(ds, out_path, encoding, codecs, chunk_config)
 
 
 if __name__ == '__main__':
@@ -163,12 +284,29 @@ if __name__ == '__main__':
         help='stage: Download zarr data from S3 to local filesystem; mount: mount S3 to local filesystem'
     )
 
+    parser.add_argument(
+        '-a', '--append',
+        action='store_true',
+        help='Append new time steps to the existing zarr store in place instead of rewriting it. The --zarr store '
+             'is modified, so --output-s3 and --output must name it. With --zarr-access stage only its metadata, '
+             'coordinates and last partial time chunk are staged and only changed objects are uploaded back; with '
+             'mount it is written directly. Time steps beyond the max duration are trimmed in whole time chunks. '
+             'Fails if the new data overlaps the existing time range'
+    )
+
     parser.add_argument(
         '-p', '--pattern',
         default='*.nc',
         help='Glob pattern to match'
     )
 
+    parser.add_argument(
+        '--keep',
+        choices=KEEP_POLICIES,
+        default='first',
+        help='Which of a set of duplicate time steps to keep: the one from the first or last input. Default: first'
+    )
+
     parser.add_argument(
         '-d', '--duration',
         type=pd.Timedelta,
@@ -177,6 +315,34 @@ if __name__ == '__main__':
              'Duration (or anything else parseable by pandas.Timedelta)'
     )
 
+    parser.add_argument(
+        '--benchmark-codecs',
+        action='store_true',
+        help='Sample a few chunks of the input, print the ratio and write/read throughput of the configured and '
+             'candidate codecs for each variable, and exit without writing'
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=parse_bytes,
+        default=None,
+        help='If set, write through a two-phase rechunk (see src/rechunk.py) whose tasks fit within this memory '
+             'budget (e.g., 8GB), instead of rechunking in a single dask graph'
+    )
+
+    parser.add_argument(
+        '--temp-dir',
+        default=None,
+        help='Directory for the intermediate store of --max-memory rechunks (default: the system temp directory)'
+    )
+
+    parser.add_argument(
+        '--output-s3',
+        default=None,
+        help='S3 URL prefix to write the output zarr store to directly, instead of the local output directory. '
+             'Chunks are uploaded as they are computed and the consolidated metadata is written last'
+    )
+
     parser.add_argument(
         '-o', '--output',
         required=True,
@@ -190,12 +356,15 @@ if __name__ == '__main__':
         help='Variables to convert'
     )
 
+    add_execution_args(parser)
+
     args = parser.parse_args()
 
     print(args)
 
     try:
-        main(args)
+        with execution_context(args):
+            main(args)
     finally:
         for sd in staging_dirs:
             try:
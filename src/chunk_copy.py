@@ -0,0 +1,322 @@
+import json
+import math
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, MutableMapping, Optional
+
+import numpy as np
+import pandas as pd
+import zarr
+from numcodecs import get_codec
+from xarray.coding.times import decode_cf_datetime
+
+COPY_WORKERS = 16
+
+# .zarray fields that must match between inputs for their chunks to be interchangeable
+ZARRAY_COMPAT_FIELDS = ('chunks', 'dtype', 'compressor', 'filters', 'fill_value', 'order', 'dimension_separator',
+                        'zarr_format')
+
+
+def _dumps(meta: dict) -> bytes:
+    return json.dumps(meta, indent=4, sort_keys=True, ensure_ascii=True, separators=(',', ': ')).encode('ascii')
+
+
+def _arrays(metadata: dict) -> Dict[str, dict]:
+    arrays = {}
+
+    for key, zarray in metadata.items():
+        if key.endswith('/.zarray'):
+            name = key[:-len('/.zarray')]
+            arrays[name] = {
+                'zarray': zarray,
+                'zattrs': metadata.get(f'{name}/.zattrs', {}),
+                'dims': metadata.get(f'{name}/.zattrs', {}).get('_ARRAY_DIMENSIONS', []),
+            }
+
+    return arrays
+
+
+def _chunk_keys(store: MutableMapping, name: str) -> List[str]:
+    prefix = f'{name}/'
+    return [k for k in store.keys() if k.startswith(prefix) and not k.split('/')[-1].startswith('.z')]
+
+
+def _check_compatible(metadatas: List[dict], dim: str, time_coord: str, chunk_config: Dict[str, int],
+                      codecs: Dict[str, dict]) -> Optional[str]:
+    # Returns the reason the inputs cannot be chunk-copied, or None if they can
+    arrays = [_arrays(m) for m in metadatas]
+    first = arrays[0]
+
+    if time_coord not in first or first[time_coord]['dims'] != [dim]:
+        return f'no 1D time coordinate {time_coord} along {dim}'
+
+    for other in arrays[1:]:
+        if set(other) != set(first):
+            return f'inputs have different arrays: {sorted(first)} vs {sorted(other)}'
+
+    for name, array in first.items():
+        dims = array['dims']
+
+        for other in arrays[1:]:
+            if other[name]['dims'] != dims:
+                return f'{name} has different dimensions across inputs'
+
+            for field in ZARRAY_COMPAT_FIELDS:
+                # The time coordinate is rewritten rather than copied, so its chunking may differ
+                if name == time_coord and field == 'chunks':
+                    continue
+
+                if other[name]['zarray'].get(field) != array['zarray'].get(field):
+                    return f'{name} has different {field} across inputs'
+
+            if dim not in dims and other[name]['zarray']['shape'] != array['zarray']['shape']:
+                return f'{name} has different shapes across inputs'
+
+        if name == time_coord:
+            for other in arrays[1:]:
+                for attr in ('units', 'calendar'):
+                    if other[name]['zattrs'].get(attr) != array['zattrs'].get(attr):
+                        return f'time coordinate has different {attr} across inputs'
+            continue
+
+        if dim not in dims:
+            continue
+
+        for d, chunk in zip(dims, array['zarray']['chunks']):
+            if d in chunk_config and chunk_config[d] != chunk:
+                return f'{name} is chunked {chunk} along {d}, target is {chunk_config[d]}'
+
+        for field, target in codecs.get(name, {}).items():
+            if array['zarray'][field] != target:
+                return f'{name} uses {field} {array["zarray"][field]}, target is {target}'
+
+        # Packed values are only meaningful with the scale and offset they were packed with
+        for other in arrays[1:]:
+            for attr in ('scale_factor', 'add_offset'):
+                if other[name]['zattrs'].get(attr) != array['zattrs'].get(attr):
+                    return f'{name} has different {attr} across inputs'
+
+    return None
+
+
+def concat_chunk_copy(
+        stores: List[MutableMapping],
+        dest: MutableMapping,
+        dim: str,
+        time_coord: str,
+        chunk_config: Dict[str, int],
+        codecs: Dict[str, dict],
+        duration: Optional[pd.Timedelta] = None,
+        workers: int = COPY_WORKERS,
+) -> bool:
+    # Concatenates zarr stores along dim by copying their compressed chunk objects into dest with renumbered time
+    # chunk indices, without decoding them. Returns False without writing anything if the inputs are incompatible
+    # with each other or the target layout, overlap in time, or are not aligned to the time chunk grid.
+    metadatas = [json.loads(s['.zmetadata'])['metadata'] for s in stores]
+
+    reason = _check_compatible(metadatas, dim, time_coord, chunk_config, codecs)
+
+    if reason is not None:
+        print(f'Chunk-copy fast path unavailable: {reason}')
+        return False
+
+    arrays = _arrays(metadatas[0])
+    time_meta = arrays[time_coord]
+    raw_times = [zarr.open_array(s, path=time_coord, mode='r')[:] for s in stores]
+
+    order = sorted(range(len(stores)), key=lambda i: raw_times[i][0] if len(raw_times[i]) > 0 else np.inf)
+    order = [i for i in order if len(raw_times[i]) > 0]
+
+    time_chunk = next(
+        (a['zarray']['chunks'][a['dims'].index(dim)] for n, a in arrays.items()
+         if dim in a['dims'] and n != time_coord),
+        chunk_config.get(dim, 1)
+    )
+
+    for pos, i in enumerate(order):
+        if np.any(np.diff(raw_times[i]) <= 0):
+            print('Chunk-copy fast path unavailable: input time coordinate is not strictly increasing')
+            return False
+
+        if pos > 0 and raw_times[i][0] <= raw_times[order[pos - 1]][-1]:
+            print('Chunk-copy fast path unavailable: inputs overlap in time')
+            return False
+
+        if pos < len(order) - 1 and len(raw_times[i]) % time_chunk != 0:
+            print(f'Chunk-copy fast path unavailable: input length {len(raw_times[i])} is not a multiple of the '
+                  f'time chunk size {time_chunk}')
+            return False
+
+    all_raw = np.concatenate([raw_times[i] for i in order])
+    times = decode_cf_datetime(all_raw, time_meta['zattrs']['units'], time_meta['zattrs'].get('calendar'))
+
+    drop = 0
+
+    if duration is not None and pd.Timedelta(times[-1] - times[0]) > duration:
+        drop = int(np.searchsorted(times, times[-1] - np.timedelta64(duration), side='left'))
+
+        if drop % time_chunk != 0:
+            print(f'Chunk-copy fast path unavailable: duration trim at index {drop} is not aligned to the time chunk '
+                  f'size {time_chunk}')
+            return False
+
+        print(f'Dropping {drop:,} time steps to satisfy max duration')
+
+    drop_chunks = drop // time_chunk
+    n_times = len(all_raw) - drop
+
+    print(f'Inputs are chunk-compatible; copying chunks of {len(order)} stores into {n_times:,} time steps')
+
+    first_store = stores[order[0]]
+    copies = []
+
+    for name, array in arrays.items():
+        zarray = array['zarray']
+        dims = array['dims']
+
+        if name == time_coord:
+            continue
+
+        if dim not in dims:
+            # Arrays without the time dimension are identical across inputs; copy them from the first
+            copies.extend((first_store, k, k) for k in _chunk_keys(first_store, name))
+            dest[f'{name}/.zarray'] = _dumps(zarray)
+        else:
+            axis = dims.index(dim)
+            separator = zarray.get('dimension_separator') or '.'
+            offset = -drop_chunks
+
+            for i in order:
+                store = stores[i]
+
+                for key in _chunk_keys(store, name):
+                    index = [int(v) for v in key[len(name) + 1:].split(separator)]
+                    index[axis] += offset
+
+                    if index[axis] >= 0:
+                        copies.append((store, key, f'{name}/{separator.join(str(v) for v in index)}'))
+
+                offset += len(raw_times[i]) // time_chunk
+
+            shape = list(zarray['shape'])
+            shape[axis] = n_times
+            dest[f'{name}/.zarray'] = _dumps({**zarray, 'shape': shape})
+
+        dest[f'{name}/.zattrs'] = _dumps(array['zattrs'])
+
+    for key in ('.zgroup', '.zattrs'):
+        if key in metadatas[0]:
+            dest[key] = _dumps(metadatas[0][key])
+
+    def copy(job):
+        src, src_key, dst_key = job
+        dest[dst_key] = src[src_key]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(copy, copies):
+            pass
+
+    print(f'Copied {len(copies):,} chunk objects')
+
+    time_zarray = time_meta['zarray']
+    time_array = zarr.open_array(
+        dest,
+        path=time_coord,
+        mode='w',
+        shape=(n_times,),
+        chunks=(max(time_zarray['chunks'][0], 1),),
+        dtype=time_zarray['dtype'],
+        compressor=None if time_zarray['compressor'] is None else get_codec(time_zarray['compressor']),
+        filters=[get_codec(f) for f in time_zarray.get('filters') or []] or None,
+        fill_value=time_zarray['fill_value'],
+    )
+    time_array[:] = all_raw[drop:]
+    dest[f'{time_coord}/.zattrs'] = _dumps(time_meta['zattrs'])
+
+    zarr.consolidate_metadata(dest)
+
+    return True
+
+
+def trim_leading_chunks(store: MutableMapping, dim: str, n_steps: int, workers: int = COPY_WORKERS) -> int:
+    # Drops up to n_steps leading time steps of a consolidated store in place, rounded down to whole time chunks so
+    # that no chunk is decoded or rewritten: the chunk objects of arrays along dim are renumbered down (server-side
+    # copies when the store is a filesystem mapping) and only 1D coordinates along dim are rewritten. Returns the
+    # number of steps dropped.
+    arrays = _arrays(json.loads(store['.zmetadata'])['metadata'])
+    moved = {n: a for n, a in arrays.items() if dim in a['dims'] and len(a['dims']) > 1}
+    rewritten = [n for n, a in arrays.items() if a['dims'] == [dim]]
+
+    step = math.lcm(*(a['zarray']['chunks'][a['dims'].index(dim)] for a in moved.values()))
+    n_steps = n_steps // step * step
+
+    if n_steps == 0:
+        return 0
+
+    fs = getattr(store, 'fs', None)
+
+    # Jobs by destination time chunk index. A wave only reads chunks whose old index is at least the shift above the
+    # ones it writes, and those are only overwritten by later waves
+    waves = defaultdict(list)
+    deletes = []
+
+    for name, array in moved.items():
+        zarray = array['zarray']
+        axis = array['dims'].index(dim)
+        separator = zarray.get('dimension_separator') or '.'
+        shift = n_steps // zarray['chunks'][axis]
+        n_chunks = math.ceil(zarray['shape'][axis] / zarray['chunks'][axis])
+        keys = set(_chunk_keys(store, name))
+
+        for key in keys:
+            index = [int(v) for v in key[len(name) + 1:].split(separator)]
+            source = index.copy()
+            source[axis] += shift
+
+            if index[axis] >= n_chunks - shift:
+                deletes.append(key)
+            elif f'{name}/{separator.join(str(v) for v in source)}' not in keys:
+                # A chunk whose replacement was never written (all fill value) must not keep its old data
+                waves[index[axis]].append((None, key))
+
+            if index[axis] >= shift:
+                index[axis] -= shift
+                waves[index[axis]].append((key, f'{name}/{separator.join(str(v) for v in index)}'))
+
+        shape = list(zarray['shape'])
+        shape[axis] -= n_steps
+        zarray['shape'] = shape
+
+    def move(job):
+        src_key, dst_key = job
+
+        if src_key is None:
+            del store[dst_key]
+        elif fs is not None:
+            fs.copy(f'{store.root}/{src_key}', f'{store.root}/{dst_key}')
+        else:
+            store[dst_key] = store[src_key]
+
+    print(f'Trimming {n_steps:,} leading steps along {dim}: renumbering {sum(len(w) for w in waves.values()):,} '
+          f'chunk objects of {len(moved)} arrays in {len(waves)} waves, deleting {len(deletes):,}')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for t in sorted(waves):
+            for _ in pool.map(move, waves[t]):
+                pass
+
+        for _ in pool.map(store.__delitem__, deletes):
+            pass
+
+    for name, array in moved.items():
+        store[f'{name}/.zarray'] = _dumps(array['zarray'])
+
+    for name in rewritten:
+        coord = zarr.open_array(store, path=name, mode='r+')
+        values = coord[n_steps:]
+        coord.resize(len(values))
+        coord[:] = values
+
+    zarr.consolidate_metadata(store)
+
+    return n_steps
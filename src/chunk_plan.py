@@ -0,0 +1,167 @@
+import math
+from typing import Callable, Dict, Optional, Union
+
+import xarray as xr
+from dask.utils import format_bytes, parse_bytes
+
+from src.codec_config import CodecConfig, estimate_compression_ratio
+
+ACCESS_PROFILES = ('time-series', 'map', 'balanced')
+
+# Used for any chunk_target setting left out of the config
+DEFAULT_CHUNK_TARGET = {
+    'size': '32MiB',
+    'basis': 'uncompressed',
+    'access': 'balanced',
+    'history': 8760,
+}
+
+# Assumed compression ratio when targeting a compressed chunk size and no data is available to estimate it from
+DEFAULT_COMPRESSION_RATIO = 4.0
+
+
+def _even(size: int, chunk: int) -> int:
+    # Same number of chunks, but as equal in size as possible so the last chunk is not a small remainder
+    chunk = max(1, min(size, chunk))
+    return math.ceil(size / math.ceil(size / chunk))
+
+
+def _split_evenly(sizes: Dict[str, int], budget: float) -> Dict[str, int]:
+    # Chunk lengths with a product of at most budget, as close to equal as the dim sizes allow
+    chunks = {}
+    remaining = len(sizes)
+
+    for d, size in sorted(sizes.items(), key=lambda item: item[1]):
+        chunks[d] = max(1, min(size, int(budget ** (1 / remaining))))
+        budget /= chunks[d]
+        remaining -= 1
+
+    return chunks
+
+
+def _split_proportionally(sizes: Dict[str, int], budget: float) -> Dict[str, int]:
+    # Chunk lengths with a product of at most budget, each the same fraction of its dim size where possible
+    chunks = {}
+    remaining = dict(sizes)
+
+    for d, size in sorted(sizes.items(), key=lambda item: item[1]):
+        fraction = (budget / math.prod(remaining.values())) ** (1 / len(remaining))
+        chunks[d] = max(1, min(size, int(size * fraction)))
+        budget /= chunks[d]
+        del remaining[d]
+
+    return chunks
+
+
+def plan_chunks(
+        sizes: Dict[str, int],
+        itemsize: int,
+        time_dim: str,
+        target_bytes: int,
+        access: str = 'balanced',
+        fixed: Optional[Dict[str, int]] = None,
+        history: Optional[int] = None,
+) -> Dict[str, int]:
+    # Chunk lengths for every dim in sizes such that a chunk holds about target_bytes (uncompressed). Dims in fixed
+    # keep their length; the others are shaped by the access profile:
+    #   time-series: long time chunks and small spatial chunks, for reading long histories at a few points
+    #   map: single (or few) time steps with large spatial chunks, for reading whole maps at a few times
+    #   balanced: every auto dim cut into about the same number of chunks
+    # Time is the growing axis: it is planned for history steps (if given) rather than its current length, and its
+    # chunk is not evened out against that length, so the plan does not change as a store grows
+    if access not in ACCESS_PROFILES:
+        raise ValueError(f'Unsupported access profile {access!r}; expected one of {ACCESS_PROFILES}')
+
+    if history is not None:
+        sizes = {**sizes, time_dim: history}
+
+    fixed = fixed if fixed is not None else {}
+    chunks = {d: min(c, sizes[d]) for d, c in fixed.items() if d in sizes}
+    auto = {d: s for d, s in sizes.items() if d not in chunks}
+
+    budget = max(1.0, target_bytes / itemsize / math.prod(chunks.values()))
+    spatial = {d: s for d, s in auto.items() if d != time_dim}
+
+    if access == 'balanced' or time_dim not in auto:
+        planned = _split_proportionally(auto, budget)
+    elif access == 'time-series':
+        planned = {time_dim: max(1, min(auto[time_dim], int(budget)))}
+        planned.update(_split_evenly(spatial, budget / planned[time_dim]))
+    else:
+        planned = _split_evenly(spatial, budget)
+        planned[time_dim] = max(1, min(auto[time_dim], int(budget / math.prod(planned.values()))))
+
+    chunks.update({d: c if d == time_dim else _even(auto[d], c) for d, c in planned.items()})
+
+    return {d: chunks[d] for d in sizes}
+
+
+def resolve_chunks(
+        chunks: Union[str, Dict[str, Union[int, str]]],
+        sizes: Dict[str, int],
+        itemsize: int,
+        time_dim: str,
+        target: Optional[dict] = None,
+        n_variables: int = 1,
+        estimate_ratio: Optional[Callable[[Dict[str, int]], float]] = None,
+) -> Dict[str, int]:
+    # chunks is either 'auto' or a mapping of dim to a chunk length or 'auto'. Explicit lengths are used as-is; auto
+    # dims are planned from target (a chunk_target config section), with time planned for its history length. When
+    # targeting a compressed size, the compression ratio is taken from target, estimated by estimate_ratio on an
+    # uncompressed plan, or assumed.
+    if chunks != 'auto' and all(c != 'auto' for c in chunks.values()):
+        return dict(chunks)
+
+    target = {**DEFAULT_CHUNK_TARGET, **(target if target is not None else {})}
+    fixed = {} if chunks == 'auto' else {d: c for d, c in chunks.items() if c != 'auto'}
+    target_bytes = parse_bytes(str(target['size']))
+    history = int(target['history'])
+    ratio = 1.0
+
+    if target['basis'] == 'compressed':
+        if 'compression_ratio' in target:
+            ratio = float(target['compression_ratio'])
+        elif estimate_ratio is not None:
+            ratio = max(1.0, estimate_ratio(plan_chunks(sizes, itemsize, time_dim, target_bytes, target['access'],
+                                                        fixed, history)))
+            print(f'Estimated compression ratio {ratio:.2f} from sampled chunks')
+        else:
+            ratio = DEFAULT_COMPRESSION_RATIO
+            print(f'Assuming compression ratio {ratio:.2f}')
+
+    planned = plan_chunks(sizes, itemsize, time_dim, int(target_bytes * ratio), target['access'], fixed, history)
+
+    chunk_bytes = math.prod(planned.values()) * itemsize
+    n_chunks = math.prod(math.ceil(sizes[d] / planned[d]) for d in sizes) * n_variables
+
+    print(f'Planned chunks {planned} for dims {sizes} and a history of {history:,} steps ({target["access"]} access, '
+          f'{target["basis"]} target {target["size"]}): {format_bytes(chunk_bytes)} uncompressed'
+          f'{f", ~{format_bytes(int(chunk_bytes / ratio))} compressed" if ratio != 1.0 else ""} per chunk, '
+          f'{n_chunks:,} chunks across {n_variables} variable(s)')
+
+    return planned
+
+
+def config_chunks(
+        config: dict,
+        ds: xr.Dataset,
+        codecs: CodecConfig,
+        sizes: Optional[Dict[str, int]] = None
+) -> Dict[str, int]:
+    # Chunk lengths by dim name for a dataset config (see util.get_config), sized for the widest data variable of ds.
+    # sizes overrides the dim lengths of ds when it is only a sample of the output (e.g., one of several inputs)
+    dims = config['dimensions']
+    chunks = config['chunks']
+
+    if chunks != 'auto':
+        chunks = {dims[d]: c for d, c in chunks.items()}
+
+    return resolve_chunks(
+        chunks,
+        {dims[d]: (sizes if sizes is not None else ds.sizes)[dims[d]] for d in ('time', 'latitude', 'longitude')},
+        max(ds[v].dtype.itemsize for v in ds.data_vars),
+        dims['time'],
+        config.get('chunk_target'),
+        len(ds.data_vars),
+        lambda chunk_config: estimate_compression_ratio(ds, codecs, chunk_config)
+    )
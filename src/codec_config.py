@@ -0,0 +1,386 @@
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dask
+import numpy as np
+import xarray as xr
+import zarr
+from dask.utils import format_bytes
+from numcodecs import BitRound, Blosc, Delta, Quantize
+from numcodecs.abc import Codec
+
+SHUFFLES = {
+    'noshuffle': Blosc.NOSHUFFLE,
+    'shuffle': Blosc.SHUFFLE,
+    'bitshuffle': Blosc.BITSHUFFLE,
+}
+
+# Codec used for variables without any codec settings
+DEFAULT_CODEC = {
+    'compressor': 'blosclz',
+    'level': 9,
+    'shuffle': 'shuffle',
+    'filters': [],
+}
+
+# Packed variables are stored as int16; this value is reserved for missing values
+PACK_DTYPE = 'int16'
+PACK_FILL_VALUE = -32768
+
+# Parameters each precision reduction method requires; packing derives missing parameters from the data
+PRECISION_PARAMS = {
+    'bitround': ['keepbits'],
+    'quantize': ['digits'],
+    'pack': [],
+}
+
+# Codecs tried by the benchmark in addition to each variable's configured codec
+BENCHMARK_CANDIDATES = [
+    {'compressor': 'blosclz', 'level': 9, 'shuffle': 'shuffle'},
+    {'compressor': 'blosclz', 'level': 5, 'shuffle': 'shuffle'},
+    {'compressor': 'lz4', 'level': 5, 'shuffle': 'shuffle'},
+    {'compressor': 'lz4', 'level': 5, 'shuffle': 'bitshuffle'},
+    {'compressor': 'zstd', 'level': 3, 'shuffle': 'shuffle'},
+    {'compressor': 'zstd', 'level': 3, 'shuffle': 'bitshuffle'},
+    {'compressor': 'zstd', 'level': 5, 'shuffle': 'bitshuffle'},
+    {'compressor': 'zlib', 'level': 5, 'shuffle': 'shuffle'},
+]
+
+
+def _describe(codec: dict) -> str:
+    if codec['compressor'] == 'none':
+        desc = 'none'
+    else:
+        desc = f'{codec["compressor"]}-{codec["level"]}-{codec["shuffle"]}'
+
+    if len(codec.get('filters', [])) > 0:
+        desc = '+'.join(codec['filters']) + '+' + desc
+
+    return desc
+
+
+def _pack_params(da: xr.DataArray, precision: dict) -> Tuple[float, float]:
+    # scale_factor and add_offset mapping the variable's range onto int16, leaving PACK_FILL_VALUE free. Values not
+    # set in the config are derived from the data's min and max
+    if 'scale_factor' in precision and 'add_offset' in precision:
+        return precision['scale_factor'], precision['add_offset']
+
+    lo, hi = (float(v) for v in dask.compute(da.min(), da.max()))
+    n_steps = np.iinfo(PACK_DTYPE).max - (PACK_FILL_VALUE + 1)
+
+    add_offset = precision.get('add_offset', (hi + lo) / 2)
+    scale_factor = precision.get('scale_factor', max(hi - add_offset, add_offset - lo) * 2 / n_steps or 1.0)
+
+    return scale_factor, add_offset
+
+
+class CodecConfig:
+    def __init__(self, default: Optional[dict] = None, variables: Optional[Dict[str, dict]] = None,
+                 precision: Optional[Dict[str, dict]] = None):
+        self.default = {**DEFAULT_CODEC, **(default if default is not None else {})}
+        self.variables = variables if variables is not None else {}
+        self.precision = precision if precision is not None else {}
+
+    def for_variable(self, var_name: str) -> dict:
+        return {**self.default, **self.variables.get(var_name, {})}
+
+    @staticmethod
+    def compressor(codec: dict) -> Optional[Codec]:
+        if codec['compressor'] == 'none':
+            return None
+
+        return Blosc(cname=codec['compressor'], clevel=codec['level'], shuffle=SHUFFLES[codec['shuffle']])
+
+    @staticmethod
+    def filters(codec: dict, dtype) -> List[Codec]:
+        filters = []
+
+        for name in codec.get('filters', []):
+            if name == 'delta':
+                filters.append(Delta(dtype=np.dtype(dtype).str))
+            else:
+                raise ValueError(f'Unsupported filter {name}')
+
+        return filters
+
+    def precision_filters(self, var_name: str, dtype) -> List[Codec]:
+        precision = self.precision.get(var_name, {})
+
+        if precision.get('method') == 'bitround':
+            return [BitRound(keepbits=precision['keepbits'])]
+        elif precision.get('method') == 'quantize':
+            return [Quantize(digits=precision['digits'], dtype=np.dtype(dtype).str)]
+
+        return []
+
+    def encoding(self, var_name: str, dtype, pack: Optional[Tuple[float, float]] = None) -> dict:
+        # pack is the (scale_factor, add_offset) of a variable packed to int16; the float dtype is restored on read
+        codec = self.for_variable(var_name)
+        encoding = {'compressor': self.compressor(codec)}
+
+        if pack is not None:
+            # A scale_factor of the original float type makes xarray decode back to that type
+            encoding.update(
+                dtype=PACK_DTYPE,
+                scale_factor=np.dtype(dtype).type(pack[0]),
+                add_offset=np.dtype(dtype).type(pack[1]),
+                _FillValue=PACK_FILL_VALUE
+            )
+            dtype = PACK_DTYPE
+
+        filters = self.precision_filters(var_name, dtype) + self.filters(codec, dtype)
+
+        if len(filters) > 0:
+            encoding['filters'] = filters
+
+        return encoding
+
+    def zarray(self, var_name: str, dtype) -> dict:
+        # The compressor and filters entries the variable's encoding produces in its .zarray metadata. Filters of a
+        # packed variable operate on the packed dtype
+        packed = self.precision.get(var_name, {}).get('method') == 'pack'
+        encoding = self.encoding(var_name, PACK_DTYPE if packed else dtype)
+        zarray = {
+            'compressor': None if encoding['compressor'] is None else encoding['compressor'].get_config(),
+            'filters': [f.get_config() for f in encoding['filters']] if 'filters' in encoding else None,
+        }
+
+        if packed:
+            zarray['dtype'] = np.dtype(PACK_DTYPE).str
+
+        return zarray
+
+
+def load_codec_config(config: dict) -> CodecConfig:
+    # config is a validated dataset or geotiff config. Its optional 'codecs' section has a default codec and per
+    # variable overrides, each of which may set any of compressor, level, shuffle and filters, and its optional
+    # 'precision' section maps variables to a lossy precision reduction
+    codecs = config.get('codecs') or {}
+
+    for vname, precision in (config.get('precision') or {}).items():
+        required = PRECISION_PARAMS[precision['method']]
+
+        if not all(p in precision for p in required):
+            raise ValueError(f'Precision method {precision["method"]} for {vname} requires {required}')
+
+    codec_config = CodecConfig(codecs.get('default'), codecs.get('variables'), config.get('precision'))
+
+    print(f'Codecs: default={_describe(codec_config.default)}, '
+          f'variables={ {v: _describe(codec_config.for_variable(v)) for v in codec_config.variables} }')
+
+    if len(codec_config.precision) > 0:
+        print(f'Precision reduction: {codec_config.precision}')
+
+    return codec_config
+
+
+def source_fill_values(ds: xr.Dataset) -> Dict[str, object]:
+    # The _FillValue each variable was decoded with, so it can be carried over to the output
+    return {
+        vname: ds[vname].encoding['_FillValue'] for vname in ds.data_vars
+        if ds[vname].encoding.get('_FillValue') is not None
+    }
+
+
+def stored_dtype(da: xr.DataArray) -> np.dtype:
+    # Masking an unpacked integer variable's _FillValue decodes it to float with NaN; its stored integer dtype is
+    # returned for those, and the decoded dtype otherwise
+    encoding = da.encoding
+
+    if da.dtype.kind == 'f' and np.dtype(encoding.get('dtype', da.dtype)).kind in 'iu' and \
+            '_FillValue' in encoding and 'scale_factor' not in encoding and 'add_offset' not in encoding:
+        return np.dtype(encoding['dtype'])
+
+    return da.dtype
+
+
+def build_encoding(codecs: CodecConfig, ds: xr.Dataset, fill_values: Optional[Dict[str, object]] = None) -> \
+        Dict[str, dict]:
+    # fill_values become the zarr fill value of their variables, so chunks holding nothing but that value (nodata over
+    # ocean, outside a swath, ...) are never written with write_empty_chunks=False
+    fill_values = fill_values if fill_values is not None else {}
+    encoding = {}
+
+    for vname in ds.data_vars:
+        precision = codecs.precision.get(vname, {})
+        pack = None
+
+        if precision.get('method') == 'pack':
+            if not np.issubdtype(ds[vname].dtype, np.floating):
+                raise ValueError(f'Cannot pack non-float variable {vname} ({ds[vname].dtype})')
+
+            pack = _pack_params(ds[vname], precision)
+            print(f'Packing {vname} to {PACK_DTYPE} with scale_factor={pack[0]}, add_offset={pack[1]}')
+
+        # A new encoding replaces the one the variable was read with, so a masked integer variable would otherwise be
+        # written as float
+        dtype = stored_dtype(ds[vname]) if pack is None else ds[vname].dtype
+        encoding[vname] = codecs.encoding(vname, dtype, pack)
+
+        if dtype != ds[vname].dtype:
+            encoding[vname]['dtype'] = dtype
+
+        # Packed variables reserve their own fill value
+        if vname in fill_values and pack is None and '_FillValue' not in ds[vname].attrs:
+            encoding[vname]['_FillValue'] = dtype.type(fill_values[vname])
+
+    return encoding
+
+
+def empty_chunk_report(store):
+    # Prints how many chunks of each variable were never written because they only held the fill value
+    group = zarr.open_consolidated(store, mode='r')
+
+    for vname, array in group.arrays():
+        if array.ndim < 2:
+            continue
+
+        skipped = array.nchunks - array.nchunks_initialized
+        chunk_bytes = int(np.prod(array.chunks)) * array.dtype.itemsize
+
+        print(f'{vname}: skipped {skipped:,} of {array.nchunks:,} chunks holding only the fill value '
+              f'{array.fill_value} ({format_bytes(skipped * chunk_bytes)} uncompressed)')
+
+
+def _sample_slices(da: xr.DataArray, chunk_config: Dict[str, int], samples: int) -> List[Dict[str, slice]]:
+    # Up to samples randomly chosen chunks of the target chunk grid, as isel indexers
+    rng = np.random.default_rng(0)
+    sizes = {d: min(chunk_config.get(d, da.sizes[d]), da.sizes[d]) for d in da.dims}
+    n_chunks = {d: -(-da.sizes[d] // sizes[d]) for d in da.dims}
+
+    slices = []
+
+    for _ in range(samples):
+        index = {d: int(rng.integers(n_chunks[d])) * sizes[d] for d in da.dims}
+        slices.append({d: slice(i, i + sizes[d]) for d, i in index.items()})
+
+    return slices
+
+
+def _sample_chunks(da: xr.DataArray, chunk_config: Dict[str, int], samples: int) -> List[np.ndarray]:
+    return [np.ascontiguousarray(da.isel(s).to_numpy()) for s in _sample_slices(da, chunk_config, samples)]
+
+
+def estimate_compression_ratio(ds: xr.Dataset, codecs: CodecConfig, chunk_config: Dict[str, int],
+                               samples: int = 3) -> float:
+    # Overall compression ratio of a few sampled chunks of every variable under their configured codecs
+    raw_bytes = 0
+    encoded_bytes = 0
+
+    for vname in ds.data_vars:
+        codec = codecs.for_variable(vname)
+        chunks = _sample_chunks(ds[vname], chunk_config, samples)
+
+        raw_bytes += sum(c.nbytes for c in chunks)
+        encoded_bytes += _encoded_size(
+            chunks,
+            codecs.precision_filters(vname, ds[vname].dtype) + CodecConfig.filters(codec, ds[vname].dtype),
+            CodecConfig.compressor(codec)
+        )
+
+    return raw_bytes / max(1, encoded_bytes)
+
+
+def _encoded_size(chunks: List[np.ndarray], filters: List[Codec], compressor: Optional[Codec]) -> int:
+    size = 0
+
+    for chunk in chunks:
+        buf = chunk
+
+        for f in filters:
+            buf = f.encode(buf)
+
+        size += len(compressor.encode(buf)) if compressor is not None else np.asarray(buf).nbytes
+
+    return size
+
+
+def precision_report(ds: xr.Dataset, store, encoding: Dict[str, dict], codecs: CodecConfig,
+                     chunk_config: Dict[str, int], samples: int = 3):
+    # Compares a few chunks of the source with the same chunks read back from the written store, and their encoded
+    # size with and without the precision reduction, for every variable with a precision setting
+    written = xr.open_zarr(store, consolidated=True)
+
+    for vname, precision in codecs.precision.items():
+        if vname not in ds.data_vars:
+            continue
+
+        slices = _sample_slices(ds[vname], chunk_config, samples)
+        source = [np.ascontiguousarray(ds[vname].isel(s).to_numpy()) for s in slices]
+        decoded = [written[vname].isel(s).to_numpy() for s in slices]
+
+        max_error = max(float(np.nanmax(np.abs(s - d), initial=0)) for s, d in zip(source, decoded))
+
+        codec = codecs.for_variable(vname)
+        compressor = CodecConfig.compressor(codec)
+        lossless = _encoded_size(source, CodecConfig.filters(codec, ds[vname].dtype), compressor)
+
+        enc = encoding[vname]
+        stored_dtype = enc.get('dtype', ds[vname].dtype)
+
+        if 'scale_factor' in enc:
+            reduced = [
+                np.where(np.isnan(c), enc['_FillValue'], np.round((c - enc['add_offset']) / enc['scale_factor']))
+                .astype(stored_dtype) for c in source
+            ]
+        else:
+            reduced = source
+
+        lossy = _encoded_size(reduced, enc.get('filters', []), compressor)
+
+        print(f'Precision reduction of {vname} ({precision["method"]}, {ds[vname].dtype} stored as '
+              f'{np.dtype(stored_dtype)}): {lossless / max(1, lossy):.2f}x smaller than lossless on '
+              f'{len(slices)} sampled chunks, max absolute error {max_error:.6g}, decoded dtype '
+              f'{written[vname].dtype}')
+
+
+def benchmark_codecs(ds: xr.Dataset, codecs: CodecConfig, chunk_config: Dict[str, int], samples: int = 3):
+    # Encodes and decodes a few chunks of each variable with each candidate codec and prints throughput and ratio
+    for vname in ds.data_vars:
+        chunks = _sample_chunks(ds[vname], chunk_config, samples)
+        raw_bytes = sum(c.nbytes for c in chunks)
+
+        configured = codecs.for_variable(vname)
+        candidates = [configured] + [
+            {**c, 'filters': []} for c in BENCHMARK_CANDIDATES if {**c, 'filters': []} != configured
+        ]
+
+        print(f'Codec benchmark for {vname} ({len(chunks)} chunks, {raw_bytes / 1024 ** 2:.2f} MiB, '
+              f'{ds[vname].dtype}):')
+        print(f'{"codec":<32}{"ratio":>8}{"write (MiB/s)":>16}{"read (MiB/s)":>15}')
+
+        for codec in candidates:
+            compressor = CodecConfig.compressor(codec)
+            filters = CodecConfig.filters(codec, ds[vname].dtype)
+
+            encoded = []
+            start = time.perf_counter()
+
+            for chunk in chunks:
+                buf = chunk
+
+                for f in filters:
+                    buf = f.encode(buf)
+
+                encoded.append(compressor.encode(buf) if compressor is not None else np.asarray(buf).tobytes())
+
+            write_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+
+            for buf in encoded:
+                if compressor is not None:
+                    buf = compressor.decode(buf)
+
+                for f in reversed(filters):
+                    buf = f.decode(buf)
+
+            read_s = time.perf_counter() - start
+
+            ratio = raw_bytes / max(1, sum(len(e) for e in encoded))
+            mib = raw_bytes / 1024 ** 2
+            label = _describe(codec) + (' *' if codec is configured else '')
+
+            print(f'{label:<32}{ratio:>8.2f}{mib / max(write_s, 1e-9):>16.1f}{mib / max(read_s, 1e-9):>15.1f}')
+
+        print('(* configured codec)')
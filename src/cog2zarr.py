@@ -1,23 +1,31 @@
 import argparse
+import math
+import multiprocessing
 import os
 import re
 import shutil
 import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
 from pathlib import PurePath
 from typing import Tuple
 
 import boto3
+import dask.array
 import numpy as np
 import pandas as pd
+import rasterio
 import rioxarray
 import xarray as xr
 import yamale
 import yaml
 import zarr
+from dask.utils import format_bytes, parse_bytes
 from odc.geo.geobox import GeoBox
 # from odc.geo.xr import ODCExtensionDs
 from odc.geo.xr import xr_reproject as reproject
+from rasterio.warp import transform_bounds
+from rasterio.windows import from_bounds
 from rioxarray.merge import merge_datasets
 from yamale.validators import Validator, DefaultValidators
 
@@ -25,7 +33,16 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 SCHEMA_PATH = os.path.join(SCRIPT_DIR, 'schema', 'geotiff_schema.yaml')
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from src.util import stage_s3
+from src.chunk_plan import resolve_chunks
+from src.codec_config import benchmark_codecs, build_encoding, empty_chunk_report, load_codec_config
+from src.execution import add_execution_args, configure_worker, execution_context
+from src.mosaic import mosaic
+from src.rechunk import rechunk_to_zarr
+from src.reproject_plan import get_plan_cache, plan_mismatches
+from src.s3_output import describe_store, output_store, write_consolidated
+from src.tile_filter import filter_tiffs, load_tile_footprints, tile_id_key_filter
+from src.time_norm import time_selection
+from src.util import stage_s3, s3_client
 
 DT_UNITS = ['year', 'month', 'day', 'hour', 'minute', 'second', 'microsecond']
 UNIT_STARTS = dict(year=0, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -81,13 +98,54 @@ class GeoTiffBandMapValidator(Validator):
                 f'unique strings')
 
 
+# Source pixels read beyond the destination footprint so resampling kernels have full support at the window edges
+RESAMPLING_MARGINS = dict(nearest=1, bilinear=2, cubic=3, cubic_spline=3, lanczos=4)
+
+# Approximate size in pixels of lazily read tile chunks; rounded to a multiple of the COG's internal tile size
+TARGET_READ_CHUNK = 2048
+
 VALIDATORS = DefaultValidators.copy()
 VALIDATORS[PythonRegexValidator.tag] = PythonRegexValidator
 VALIDATORS[GeoTiffBandMapValidator.tag] = GeoTiffBandMapValidator
 
 
-def _open_tiff(path, band_map):
-    return rioxarray.open_rasterio(path).to_dataset('band').rename(band_map)
+def _open_tiff(path, band_map, gbox: GeoBox = None, resampling_method: str = 'nearest'):
+    # Header-only read to get the internal tiling and the window overlapping the destination grid
+    with rasterio.open(path) as src:
+        block_h, block_w = src.block_shapes[0]
+        height, width = src.height, src.width
+        crs, transform = src.crs, src.transform
+
+    chunks = {
+        'band': 1,
+        'y': block_h * max(1, TARGET_READ_CHUNK // block_h),
+        'x': block_w * max(1, TARGET_READ_CHUNK // block_w),
+    }
+
+    tiff = rioxarray.open_rasterio(path, chunks=chunks)
+
+    if gbox is not None:
+        # Destination bounds padded by one output pixel, mapped into the tile CRS, then padded by the resampling
+        # kernel radius in source pixels
+        res = abs(gbox.resolution.x)
+        left, bottom, right, top = gbox.boundingbox
+        bounds = transform_bounds(str(gbox.crs), crs, left - res, bottom - res, right + res, top + res,
+                                  densify_pts=21)
+        window = from_bounds(*bounds, transform=transform)
+        margin = RESAMPLING_MARGINS.get(resampling_method, 2)
+
+        r0 = int(np.clip(np.floor(window.row_off) - margin, 0, height - 1))
+        c0 = int(np.clip(np.floor(window.col_off) - margin, 0, width - 1))
+        r1 = int(np.clip(np.ceil(window.row_off + window.height) + margin, r0 + 1, height))
+        c1 = int(np.clip(np.ceil(window.col_off + window.width) + margin, c0 + 1, width))
+
+        if (r1 - r0, c1 - c0) != (height, width):
+            print(f'Reading window rows [{r0}, {r1}) cols [{c0}, {c1}) of {height}x{width} tile '
+                  f'{os.path.basename(path)}')
+
+        tiff = tiff.isel(y=slice(r0, r1), x=slice(c0, c1))
+
+    return tiff.to_dataset('band').rename(band_map)
 
 
 def _get_bbox_from_config(config) -> Tuple[float, float, float, float]:
@@ -102,6 +160,19 @@ def _get_bbox_from_config(config) -> Tuple[float, float, float, float]:
         return -180.0, -90.0, 180.0, 90.0
 
 
+def _input_itemsize(path: str) -> int:
+    with rasterio.open(path) as src:
+        return max(np.dtype(dtype).itemsize for dtype in src.dtypes)
+
+
+def _get_gbox(config) -> GeoBox:
+    return GeoBox.from_bbox(
+        _get_bbox_from_config(config),
+        "epsg:4326",
+        resolution=config['resolution_deg'],
+    )
+
+
 def test(schema):
     test_data_dir = '/Users/rileykk/czdt/czdt-iss-cf2zarr/reproj_experiments/odc_geo/data/OPERA_L3_DSWx-S1/WTR'
     test_cfg = '/Users/rileykk/czdt/czdt-iss-cf2zarr/sample_opera_cfg.yaml'
@@ -196,13 +267,145 @@ def test2(schema):
     final_ds.to_netcdf('/Users/rileykk/czdt/czdt-iss-cf2zarr/test.nc')
 
 
+def _process_timestamp(timestamp, tiffs, config, gbox, resampling_method, plan_cache=None) -> xr.Dataset:
+    mosaic_config = config.get('mosaic', {})
+
+    print(f'Mosaicking {len(tiffs)} tiffs onto the EPSG:4326 canvas for timestamp {timestamp}')
+    reprojected = mosaic(
+        (_open_tiff(f, config['band_map'], gbox, resampling_method) for f in sorted(tiffs)),
+        gbox,
+        resampling_method,
+        config.get('nodata', 255),
+        rule=mosaic_config.get('rule', 'first-valid'),
+        confidence_band=mosaic_config.get('confidence_band'),
+        plan_cache=plan_cache
+    )
+
+    print('Adding timestamp')
+    reprojected = reprojected.expand_dims('time').assign_coords(
+        time=[np.datetime64(timestamp, 'ns')]
+    )
+
+    print(f'Finished dataset for timestamp:\n{reprojected}')
+    return reprojected
+
+
+def _process_time_chunk(timestamps, times, config, gbox, resampling_method, plan_cache=None) -> xr.Dataset:
+    return xr.concat(
+        [_process_timestamp(t, times[t], config, gbox, resampling_method, plan_cache) for t in timestamps],
+        dim='time'
+    )
+
+
+def _process_timestamp_worker(timestamp, tiffs, config, resampling_method, use_plans, plan_cache_dir):
+    # Worker process entry point. Returns the timestamp's mosaic and this task's reprojection plan statistics
+    plan_cache = get_plan_cache(plan_cache_dir) if use_plans else None
+    stats_before = plan_cache.stats() if plan_cache is not None else {}
+
+    reprojected = _process_timestamp(timestamp, tiffs, config, _get_gbox(config), resampling_method, plan_cache)
+
+    stats = {k: v - stats_before[k] for k, v in plan_cache.stats().items()} if plan_cache is not None else {}
+    return reprojected, stats
+
+
+def _check_plans(tiffs, config, gbox, resampling_method) -> bool:
+    # Compares the reprojection plan of every tile with odc-geo/GDAL nearest-neighbour resampling, on the same source
+    # windows cog2zarr reads. Returns True if every pixel matches
+    if resampling_method != 'nearest':
+        raise ValueError(f'Reprojection plans only support nearest resampling, not {resampling_method}')
+
+    matched = True
+
+    for f in sorted(tiffs):
+        tile = _open_tiff(f, config['band_map'], gbox, resampling_method)
+
+        for name, (mismatched, total) in plan_mismatches(tile, gbox, config.get('nodata', 255)).items():
+            print(f'{os.path.basename(f)} {name}: {mismatched:,} of {total:,} pixels differ from odc-geo/GDAL')
+            matched &= mismatched == 0
+
+    return matched
+
+
+def _mosaics(timestamps, times, config, gbox, resampling_method, plan_cache, workers, plan_cache_dir, window,
+             threads_per_worker=None):
+    # Yields (index, mosaic) for every timestamp as it completes, computed here or by a pool of worker processes. A
+    # timestamp is only submitted while it is within window of the earliest one still in flight, so results waiting
+    # for the rest of their time chunk stay bounded
+    if workers <= 1:
+        for i, t in enumerate(timestamps):
+            yield i, _process_timestamp(t, times[t], config, gbox, resampling_method, plan_cache)
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=configure_worker,
+            initargs=(threads_per_worker,)
+    ) as pool:
+        pending = {}
+        next_index = 0
+
+        while next_index < len(timestamps) or len(pending) > 0:
+            while next_index < len(timestamps) and next_index < min(pending.values(), default=next_index) + window:
+                t = timestamps[next_index]
+                future = pool.submit(_process_timestamp_worker, t, times[t], config, resampling_method,
+                                     plan_cache is not None, plan_cache_dir)
+                pending[future] = next_index
+                next_index += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in sorted(done, key=pending.get):
+                reprojected, stats = future.result()
+
+                if plan_cache is not None:
+                    plan_cache.add_stats(stats)
+                yield pending.pop(future), reprojected
+
+
+def _create_store(path, template: xr.Dataset, timestamps, chunk_config, encoding):
+    # Lazy placeholder covering every timestamp: only metadata and coordinates are written here, data variables are
+    # filled in region by region
+    data_vars = {}
+
+    for name, var in template.data_vars.items():
+        shape = (len(timestamps),) + var.shape[1:]
+        chunks = tuple(chunk_config.get(d, n) for d, n in zip(var.dims, shape))
+        data_vars[name] = (var.dims, dask.array.zeros(shape, dtype=var.dtype, chunks=chunks), var.attrs)
+
+    coords = {k: v for k, v in template.coords.items() if k != 'time'}
+    coords['time'] = [np.datetime64(t, 'ns') for t in timestamps]
+
+    xr.Dataset(data_vars, coords=coords, attrs=template.attrs).to_zarr(
+        path,
+        mode='w-',
+        compute=False,
+        encoding=encoding,
+        consolidated=False,
+        write_empty_chunks=False
+    )
+
+
+def _write_region(path, block: xr.Dataset, start: int):
+    # Coordinates were written with the store; only data variables are written to the region
+    block = block.drop_vars(list(block.coords))
+
+    block.to_zarr(
+        path,
+        mode='r+',
+        region={'time': slice(start, start + block.sizes['time'])},
+        consolidated=False,
+        write_empty_chunks=False
+    )
+
+
 def main(args):
     config_path = args.config
     pattern = args.pattern
     output = args.output
 
     session = boto3.Session(profile_name=os.getenv('AWS_PROFILE', None))
-    client = session.client('s3')
+    client = s3_client(session)
 
     schema = yamale.make_schema(SCHEMA_PATH, validators=VALIDATORS)
     data = yamale.make_data(config_path)
@@ -215,7 +418,23 @@ def main(args):
     if config['resolution_deg'] <= 0:
         raise ValueError('resolution_deg must be greater than zero')
 
-    input_stage_dir = stage_s3(args.input_s3, client)
+    if config.get('mosaic', {}).get('rule') == 'max-confidence' and \
+            config['mosaic'].get('confidence_band') not in config['band_map'].values():
+        raise ValueError('max-confidence mosaicking requires confidence_band to name a band in band_map')
+
+    bbox = _get_bbox_from_config(config)
+
+    if args.tile_footprints is not None:
+        key_filter = tile_id_key_filter(
+            config['filename_pattern'],
+            args.tile_id_group,
+            load_tile_footprints(args.tile_footprints),
+            bbox
+        )
+    else:
+        key_filter = None
+
+    input_stage_dir = stage_s3(args.input_s3, client, key_filter=key_filter)
     staging_dirs.append(input_stage_dir)
 
     times = {}
@@ -232,6 +451,12 @@ def main(args):
     if len(input_tiffs) == 0:
         raise ValueError('no tiffs found in input dir')
 
+    if 'bbox' in config:
+        input_tiffs = filter_tiffs(input_tiffs, bbox)
+
+        if len(input_tiffs) == 0:
+            raise ValueError(f'no input tiffs intersect bbox {bbox}')
+
     for tiff in input_tiffs:
         match = filename_pattern.match(os.path.basename(tiff))
         if match is None:
@@ -250,80 +475,156 @@ def main(args):
 
     print(f'Mapped inputs to {len(times)} times')
 
-    gbox = GeoBox.from_bbox(
-        _get_bbox_from_config(config),
-        "epsg:4326",
-        resolution=config['resolution_deg'],
-    )
+    gbox = _get_gbox(config)
+
+    timestamps = sorted(times.keys())
+
+    if args.duration is not None:
+        # Tiffs sharing a timestamp are mosaicked, so timestamps are already unique; only the duration window applies
+        indices, _, n_trimmed = time_selection(np.array(timestamps, dtype='datetime64[ns]'), duration=args.duration)
+
+        if n_trimmed > 0:
+            timestamps = [timestamps[i] for i in indices]
+
+            print(f'Dataset duration exceeds max duration provided; dropped {n_trimmed:,} time steps. New dataset '
+                  f'duration: {pd.Timedelta(timestamps[-1] - timestamps[0])}')
 
-    reprojected_slices = []
     resampling_method = config.get('resampling_method', 'nearest')
+    plan_cache = get_plan_cache(args.plan_cache_dir) if args.reprojection_plans else None
+
+    if args.check_reprojection_plans:
+        if not _check_plans(times[timestamps[0]], config, gbox, resampling_method):
+            raise ValueError('Reprojection plans differ from odc-geo/GDAL nearest-neighbour resampling')
+
+        print('Reprojection plans match odc-geo/GDAL nearest-neighbour resampling for every tile')
+        return
+
+    # Output dtypes are only known once tiles are read, so auto chunks are sized for the first input's dtype and a
+    # compressed target uses the configured or an assumed compression ratio
+    chunk_config = resolve_chunks(
+        config.get('chunks', {
+            'time': 24,
+            'latitude': 90,
+            'longitude': 90,
+        }),
+        {'time': len(timestamps), 'latitude': gbox.shape[0], 'longitude': gbox.shape[1]},
+        _input_itemsize(times[timestamps[0]][0]),
+        'time',
+        config.get('chunk_target'),
+        len(config['band_map'])
+    )
+    print(f'Setting chunk config: {chunk_config}')
 
-    for timestamp in sorted(times.keys()):
-        print(f'Opening and merging {len(times[timestamp])} tiffs for timestamp {timestamp}')
-        times[timestamp] = merge_datasets(
-            [_open_tiff(f, config['band_map']) for f in times[timestamp]]
-        )
+    codecs = load_codec_config(config)
+    fill_values = {vname: config.get('nodata', 255) for vname in config['band_map'].values()}
 
-        print('Reprojecting to EPSG:4326')
-        reprojected = reproject(
-            src=times[timestamp],
-            how=gbox,
-            resampling=resampling_method,
-            dst_nodata=255
-        )
+    if args.benchmark_codecs:
+        block = _process_time_chunk(timestamps[:chunk_config['time']], times, config, gbox, resampling_method,
+                                    plan_cache)
+        benchmark_codecs(block, codecs, chunk_config)
+        return
 
-        print('Adding timestamp')
-        reprojected = reprojected.expand_dims('time').assign_coords(
-            time=[np.datetime64(timestamp, 'ns')]
-        )
+    out_path = output_store(
+        output,
+        args.output_s3,
+        session.get_credentials().get_frozen_credentials() if args.output_s3 is not None else None
+    )
 
-        print(f'Finished dataset for timestamp:\n{reprojected}')
-        reprojected_slices.append(reprojected)
+    if args.stream or args.pool_workers > 1:
+        # Timestamps are mosaicked one at a time (or concurrently by worker processes) and each zarr time chunk is
+        # written to its region of a pre-created store as soon as all of its timestamps are done, so peak memory is
+        # bounded by a few time steps rather than the whole time series. Chunks are assembled in timestamp order,
+        # so the output is identical to the serial path
+        time_chunk = chunk_config['time']
+        n_chunks = math.ceil(len(timestamps) / time_chunk)
 
-    final_ds = xr.concat(reprojected_slices, dim='time').sortby('time')
-    print(f'Concatenated all timestamps into single dataset:\n{final_ds}')
+        # Rough peak memory: each worker holds its canvases and source tile windows, up to two finished mosaics per
+        # worker wait here, and so does the time chunk being assembled along with its concatenation
+        timestamp_bytes = gbox.shape[0] * gbox.shape[1] * _input_itemsize(times[timestamps[0]][0]) * \
+            len(config['band_map'])
+        workers = min(args.pool_workers, len(timestamps))
 
-    if args.duration is not None:
-        ds_duration = pd.Timedelta((final_ds['time'][-1] - final_ds['time'][0]).data.item())
+        if args.max_memory is not None:
+            budget = args.max_memory - 2 * min(time_chunk, len(timestamps)) * timestamp_bytes
+            workers = min(workers, max(1, budget // (5 * timestamp_bytes)))
 
-        print(f'new dataset duration: {ds_duration}')
+        if workers > 1:
+            print(f'Mosaicking {len(timestamps):,} timestamps with {workers} workers (estimated '
+                  f'{format_bytes(3 * timestamp_bytes)} per worker)')
 
-        if ds_duration > args.duration:
-            print('Dataset duration exceeds max duration provided')
+        buffers = {}
+        created = False
+        written = 0
 
-            idx = 0
+        for i, reprojected in _mosaics(timestamps, times, config, gbox, resampling_method, plan_cache, workers,
+                                       args.plan_cache_dir, 2 * workers, args.threads_per_worker):
+            buffers.setdefault(i // time_chunk, {})[i] = reprojected
 
-            while pd.Timedelta((final_ds['time'][-1] - final_ds['time'][idx]).data.item()) > args.duration:
-                idx += 1
+            # The first timestamp's mosaic is the template for the output store
+            if i == 0:
+                print(f'Creating zarr store for {len(timestamps):,} time steps: {describe_store(out_path)}')
+                _create_store(out_path, reprojected, timestamps, chunk_config,
+                              build_encoding(codecs, reprojected, fill_values))
+                created = True
 
-            final_ds = final_ds.isel(time=slice(idx, None))
+            if not created:
+                continue
 
-            print(f'Dropped {idx:,} time steps. New dataset duration: '
-                  f'{pd.Timedelta((final_ds["time"][-1] - final_ds["time"][0]).data.item())}')
+            for k in sorted(buffers):
+                start = k * time_chunk
 
-    chunk_config = config.get('chunks', {
-        'time': 24,
-        'latitude': 90,
-        'longitude': 90,
-    })
-    print(f'Setting chunk config: {chunk_config}')
+                if len(buffers[k]) < min(time_chunk, len(timestamps) - start):
+                    continue
 
-    for var in final_ds.data_vars:
-        final_ds[var] = final_ds[var].chunk(chunk_config)
+                block = xr.concat([buffers[k][j] for j in sorted(buffers[k])], dim='time')
+                del buffers[k]
 
-    compressor = zarr.Blosc(cname="blosclz", clevel=9)
-    encoding = {vname: {'compressor': compressor} for vname in final_ds.data_vars}
+                written += 1
+                print(f'[{written:,}/{n_chunks:,}] Writing time steps [{start:,}, {start + block.sizes["time"]:,}) '
+                      f'to {describe_store(out_path)}')
+                _write_region(out_path, block, start)
 
-    print(f'Writing to zarr file: {os.path.join("output", output)}')
+        # Regions are written without touching the consolidated metadata, which is only written once the store is
+        # complete
+        zarr.consolidate_metadata(out_path)
 
-    final_ds.to_zarr(
-        os.path.join('output', output),
-        mode='w-',
-        encoding=encoding,
-        consolidated=True,
-        write_empty_chunks=False
-    )
+        if plan_cache is not None:
+            print(plan_cache.summary())
+
+        empty_chunk_report(out_path)
+        return
+
+    reprojected_slices = [
+        _process_timestamp(t, times[t], config, gbox, resampling_method, plan_cache) for t in timestamps
+    ]
+
+    if plan_cache is not None:
+        print(plan_cache.summary())
+
+    final_ds = xr.concat(reprojected_slices, dim='time').sortby('time')
+    print(f'Concatenated all timestamps into single dataset:\n{final_ds}')
+
+    print(f'Writing to zarr file: {describe_store(out_path)}')
+
+    if args.max_memory is not None:
+        # The mosaics are in memory, so without this the whole time series would be a single source chunk of the
+        # rechunk; each timestamp is one source chunk instead, as it was mosaicked
+        final_ds = final_ds.chunk({'time': 1})
+        rechunk_to_zarr(final_ds, chunk_config, out_path, build_encoding(codecs, final_ds, fill_values),
+                        args.max_memory, args.temp_dir)
+    else:
+        for var in final_ds.data_vars:
+            final_ds[var] = final_ds[var].chunk(chunk_config)
+
+        write_consolidated(
+            final_ds,
+            out_path,
+            mode='w-',
+            encoding=build_encoding(codecs, final_ds, fill_values),
+            write_empty_chunks=False
+        )
+
+    empty_chunk_report(out_path)
 
 
 if __name__ == '__main__':
@@ -355,18 +656,97 @@ if __name__ == '__main__':
              'Duration (or anything else parseable by pandas.Timedelta)'
     )
 
+    parser.add_argument(
+        '--tile-footprints',
+        default=None,
+        help='JSON file mapping tile IDs to [min_lon, min_lat, max_lon, max_lat] footprints. Input objects whose '
+             'tile ID footprint does not intersect the config bbox are not staged'
+    )
+
+    parser.add_argument(
+        '--tile-id-group',
+        default='tile_id',
+        help='Name of the filename_pattern group holding the tile ID used with --tile-footprints'
+    )
+
+    parser.add_argument(
+        '--benchmark-codecs',
+        action='store_true',
+        help='Process the first time chunk, print the ratio and write/read throughput of the configured and '
+             'candidate codecs for each variable, and exit without writing'
+    )
+
+    parser.add_argument(
+        '--output-s3',
+        default=None,
+        help='S3 URL prefix to write the output zarr store to directly, instead of the local output directory. '
+             'Chunks are uploaded as they are computed and the consolidated metadata is written last'
+    )
+
     parser.add_argument(
         '-o', '--output',
         required=True,
         help='Output zarr filename'
     )
 
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        help='Pre-create the output store and write each time chunk as soon as it is reprojected instead of holding '
+             'every time step in memory until the end'
+    )
+
+    add_execution_args(
+        parser,
+        pool_workers_help='Number of worker processes used to mosaic timestamps concurrently (default: 1). Values '
+                          'above 1 imply --stream; finished time chunks are written to disjoint time regions of the '
+                          'output store. Each process uses --threads-per-worker threads for its dask computations'
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=parse_bytes,
+        default=None,
+        help='Memory budget (e.g., 16GB). Its meaning depends on the write path: with --stream or --pool-workers, it '
+             'only limits the number of mosaicking workers based on the estimated memory needed per timestamp; '
+             'otherwise the in-memory mosaics are written through a two-phase rechunk (see src/rechunk.py) whose '
+             'tasks fit within it'
+    )
+
+    parser.add_argument(
+        '--temp-dir',
+        default=None,
+        help='Directory for the intermediate store of --max-memory rechunks (default: the system temp directory)'
+    )
+
+    parser.add_argument(
+        '--reprojection-plans',
+        action='store_true',
+        help='Warp tiles with nearest resampling from precomputed reprojection plans (see src/reproject_plan.py) '
+             'instead of odc-geo/GDAL. Check them against odc-geo/GDAL with --check-reprojection-plans first'
+    )
+
+    parser.add_argument(
+        '--check-reprojection-plans',
+        action='store_true',
+        help='Warp every tile of the first timestamp both from a reprojection plan and with odc-geo/GDAL, print how '
+             'many pixels differ, and exit without writing. Fails if any pixel differs'
+    )
+
+    parser.add_argument(
+        '--plan-cache-dir',
+        default=None,
+        help='Directory in which to persist reprojection plans (with --reprojection-plans) so repeating tiles are '
+             'warped from cached plans in later runs. Plans are only cached in memory if not set'
+    )
+
     args = parser.parse_args()
 
     print(args)
 
     try:
-        main(args)
+        with execution_context(args):
+            main(args)
     finally:
         for sd in staging_dirs:
             try:
@@ -0,0 +1,120 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, Optional
+
+import xarray as xr
+import yamale
+import yaml
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCHEMA_PATH = os.path.join(SCRIPT_DIR, 'schema', 'cog_profile_schema.yaml')
+
+# Creation options supported by the GDAL COG driver
+DRIVER_OPTIONS = [
+    'blocksize', 'compress', 'level', 'max_z_error', 'max_z_error_overview', 'quality', 'jxl_lossless',
+    'jxl_effort', 'jxl_distance', 'jxl_alpha_distance', 'num_threads', 'nbits', 'predictor', 'bigtiff',
+    'resampling', 'overview_resampling', 'warp_resampling', 'overviews', 'overview_count', 'overview_compress',
+    'overview_quality', 'overview_predictor', 'geotiff_version', 'sparse_ok', 'statistics', 'tiling_scheme',
+    'zoom_level', 'zoom_level_strategy', 'target_srs', 'res', 'extent', 'aligned_levels', 'add_alpha'
+]
+
+PRESETS = {
+    # Fastest to write: light ZSTD, multithreaded, no overviews
+    'fast': {
+        'compress': 'ZSTD',
+        'level': 1,
+        'num_threads': 'ALL_CPUS',
+        'overviews': 'NONE',
+    },
+    # High-ratio output: high-level ZSTD with a predictor suited to the data type (pays off on continuous data)
+    'small': {
+        'compress': 'ZSTD',
+        'level': 15,
+        'predictor': 'YES',
+        'num_threads': 'ALL_CPUS',
+    },
+    # Tiled for map clients: 256px blocks, averaged overviews, widely supported DEFLATE
+    'web': {
+        'compress': 'DEFLATE',
+        'predictor': 'YES',
+        'blocksize': 256,
+        'overviews': 'AUTO',
+        'overview_resampling': 'AVERAGE',
+        'num_threads': 'ALL_CPUS',
+    },
+}
+
+
+def _resolve_profile(profile: dict, base: Optional[dict] = None) -> dict:
+    # Options of a profile: its preset's (or, without a preset, base's) with its own options layered on top
+    options = dict(PRESETS[profile['preset']]) if 'preset' in profile else dict(base if base is not None else {})
+    options.update({k.lower(): v for k, v in profile.get('options', {}).items()})
+
+    unsupported = [k for k in options if k not in DRIVER_OPTIONS]
+
+    if len(unsupported) > 0:
+        raise ValueError(f'Unsupported COG driver options: {unsupported}. Supported options: {DRIVER_OPTIONS}')
+
+    return options
+
+
+class CogProfiles:
+    def __init__(self, default: Optional[dict] = None, variables: Optional[Dict[str, dict]] = None):
+        self.default = default if default is not None else {}
+        self.variables = variables if variables is not None else {}
+
+    def for_variable(self, var_name: str) -> dict:
+        return self.variables.get(var_name, self.default)
+
+
+def load_cog_profiles(profile: Optional[str]) -> CogProfiles:
+    # profile is either the name of a built-in preset applied to every variable or the path to a YAML profile file
+    if profile is None:
+        return CogProfiles()
+
+    if profile in PRESETS:
+        print(f'Using COG preset {profile}: {PRESETS[profile]}')
+        return CogProfiles(_resolve_profile({'preset': profile}))
+
+    schema = yamale.make_schema(SCHEMA_PATH)
+    data = yamale.make_data(profile)
+
+    yamale.validate(schema, data, strict=True)
+
+    with open(profile, 'r') as fp:
+        config = yaml.safe_load(fp)
+
+    default = _resolve_profile(config.get('default', {}))
+
+    # Per-variable profiles without a preset override the default profile rather than GDAL's defaults
+    profiles = CogProfiles(
+        default,
+        {var_name: _resolve_profile(p, default) for var_name, p in config.get('variables', {}).items()}
+    )
+
+    print(f'Validated and loaded COG profiles from {profile}: default={profiles.default}, '
+          f'variables={profiles.variables}')
+
+    return profiles
+
+
+def benchmark_presets(data: xr.DataArray, label: str):
+    # Writes one 2D slice with GDAL defaults and each preset and prints write time and size
+    out_dir = tempfile.mkdtemp()
+
+    try:
+        print(f'COG preset benchmark for {label}:')
+        print(f'{"preset":<10}{"write (s)":>12}{"size (MiB)":>14}')
+
+        for name, options in [('default', {})] + list(PRESETS.items()):
+            out_path = os.path.join(out_dir, f'{name}.tif')
+
+            start = time.perf_counter()
+            data.rio.to_raster(out_path, driver='COG', sharing=False, **options)
+            elapsed = time.perf_counter() - start
+
+            print(f'{name:<10}{elapsed:>12.3f}{os.path.getsize(out_path) / 1024 ** 2:>14.2f}')
+    finally:
+        shutil.rmtree(out_dir)
@@ -0,0 +1,125 @@
+import argparse
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+import dask
+from dask.utils import format_bytes, parse_bytes
+
+SCHEDULERS = ('threads', 'processes', 'local-cluster')
+
+
+def add_execution_args(parser: argparse.ArgumentParser, pool_workers_help: Optional[str] = None):
+    # Options shared by every entry point to control how dask computations are executed. Entry points with their own
+    # process pool pass pool_workers_help to also get --pool-workers, which sizes that pool independently of dask
+    group = parser.add_argument_group('execution')
+
+    group.add_argument(
+        '--scheduler',
+        choices=SCHEDULERS,
+        default='threads',
+        help='threads: dask threaded scheduler in this process (default); processes: dask multiprocessing '
+             'scheduler; local-cluster: a dask.distributed LocalCluster on this node, with memory limits and spill '
+             'to disk (requires the distributed package)'
+    )
+
+    group.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=None,
+        help='Number of worker processes for the processes and local-cluster schedulers (default: one per core)'
+    )
+
+    if pool_workers_help is not None:
+        group.add_argument(
+            '--pool-workers',
+            type=int,
+            default=1,
+            help=pool_workers_help
+        )
+
+    group.add_argument(
+        '--threads-per-worker',
+        type=int,
+        default=None,
+        help='Number of threads per worker process; with the threads scheduler, the total number of threads '
+             '(default: one per core)'
+    )
+
+    group.add_argument(
+        '--memory-limit',
+        type=parse_bytes,
+        default=None,
+        help='Memory limit per local-cluster worker (e.g., 4GB), above which it spills to disk and is eventually '
+             'restarted. Default: the node memory divided among the workers'
+    )
+
+    group.add_argument(
+        '--performance-report',
+        default=None,
+        help='Path of an HTML dask performance report to write (local-cluster only)'
+    )
+
+    group.add_argument(
+        '--spill-dir',
+        default=None,
+        help='Directory local-cluster workers spill to (default: the system temp directory)'
+    )
+
+
+def configure_worker(threads_per_worker: Optional[int]):
+    # Applies --threads-per-worker to the dask computations run inside a worker process of a process pool
+    if threads_per_worker is not None:
+        dask.config.set(scheduler='threads', num_workers=threads_per_worker)
+
+
+@contextmanager
+def execution_context(args: argparse.Namespace):
+    # Runs the body with dask configured from the execution options; yields the distributed Client for the
+    # local-cluster scheduler and None otherwise
+    if args.scheduler != 'local-cluster':
+        if args.memory_limit is not None or args.performance_report is not None:
+            print('--memory-limit and --performance-report only apply to --scheduler local-cluster; ignoring them')
+
+        if args.scheduler == 'threads':
+            num_workers = args.threads_per_worker
+        else:
+            num_workers = args.workers
+
+        print(f'Using the dask {args.scheduler} scheduler with {num_workers or "default number of"} workers')
+
+        with dask.config.set(scheduler=args.scheduler, num_workers=num_workers):
+            yield None
+
+        return
+
+    try:
+        from distributed import Client, LocalCluster, performance_report
+    except ImportError:
+        raise ImportError('--scheduler local-cluster requires the distributed package')
+
+    cluster = LocalCluster(
+        n_workers=args.workers,
+        threads_per_worker=args.threads_per_worker,
+        memory_limit=args.memory_limit if args.memory_limit is not None else 'auto',
+        local_directory=args.spill_dir,
+        processes=True
+    )
+
+    try:
+        with Client(cluster) as client:
+            workers = client.scheduler_info()['workers'].values()
+
+            print(f'Started local dask cluster with {len(workers)} workers, '
+                  f'{sum(w["nthreads"] for w in workers)} threads and '
+                  f'{format_bytes(sum(w["memory_limit"] for w in workers))} memory. Dashboard: {client.dashboard_link}')
+
+            report = nullcontext() if args.performance_report is None else \
+                performance_report(filename=args.performance_report)
+
+            with report:
+                yield client
+
+            if args.performance_report is not None:
+                print(f'Wrote dask performance report to {args.performance_report}')
+    finally:
+        cluster.close()
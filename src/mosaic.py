@@ -0,0 +1,82 @@
+from typing import Iterable, Optional
+
+import numpy as np
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import wrap_xr
+
+from src.reproject_plan import PlanCache, warp_tile
+
+COMPOSITE_RULES = ('first-valid', 'last-valid', 'max-confidence')
+
+
+def _valid(values: np.ndarray, nodata) -> np.ndarray:
+    if nodata is None:
+        return np.ones(values.shape, dtype=bool)
+    if np.isnan(nodata):
+        return ~np.isnan(values)
+    return values != nodata
+
+
+def mosaic(
+        tiles: Iterable[xr.Dataset],
+        dst_gbox: GeoBox,
+        resampling: str,
+        nodata,
+        rule: str = 'first-valid',
+        confidence_band: Optional[str] = None,
+        plan_cache: Optional[PlanCache] = None
+) -> xr.Dataset:
+    # Warps each tile straight into a shared canvas on dst_gbox and composites it there, so no intermediate mosaic is
+    # built in the tiles' native grid and tiles may be in different CRSs. Tiles are consumed one at a time.
+    #   first-valid:    each canvas pixel keeps the first valid value it receives (per variable)
+    #   last-valid:     each valid tile pixel overwrites the canvas (per variable)
+    #   max-confidence: all variables are taken from the tile with the highest confidence_band value at each pixel
+    if rule not in COMPOSITE_RULES:
+        raise ValueError(f'Unsupported compositing rule {rule}; expected one of {COMPOSITE_RULES}')
+
+    if rule == 'max-confidence' and confidence_band is None:
+        raise ValueError('max-confidence compositing requires a confidence band')
+
+    canvases = None
+    attrs = {}
+
+    for tile in tiles:
+        window, arrays = warp_tile(tile, dst_gbox, resampling, nodata, plan_cache)
+
+        if canvases is None:
+            canvases = {name: np.full(dst_gbox.shape, nodata, dtype=a.dtype) for name, a in arrays.items()}
+            attrs = {
+                name: {k: v for k, v in var.attrs.items() if k not in ('_FillValue', 'nodata')}
+                for name, var in tile.data_vars.items()
+            }
+
+        if rule == 'max-confidence':
+            tile_conf = arrays[confidence_band]
+            canvas_conf = canvases[confidence_band][window]
+
+            take = _valid(tile_conf, nodata) & (~_valid(canvas_conf, nodata) | (tile_conf > canvas_conf))
+
+            for name, values in arrays.items():
+                canvases[name][window][take] = values[take]
+        else:
+            for name, values in arrays.items():
+                canvas = canvases[name][window]
+                take = _valid(values, nodata)
+
+                if rule == 'first-valid':
+                    take &= ~_valid(canvas, nodata)
+
+                canvas[take] = values[take]
+
+    if canvases is None:
+        raise ValueError('No tiles to mosaic')
+
+    data_vars = {}
+
+    for name, canvas in canvases.items():
+        da = wrap_xr(canvas, dst_gbox, nodata=nodata)
+        da.attrs.update(attrs[name])
+        data_vars[name] = da
+
+    return xr.Dataset(data_vars)
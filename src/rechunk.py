@@ -0,0 +1,242 @@
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+from typing import Dict, Optional
+
+import boto3
+import dask
+import xarray as xr
+from dask.utils import format_bytes, parse_bytes
+from numcodecs import Blosc
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+from src.chunk_plan import config_chunks
+from src.codec_config import build_encoding, empty_chunk_report, load_codec_config, source_fill_values, stored_dtype
+from src.execution import add_execution_args, execution_context
+from src.s3_output import describe_store, output_store, write_consolidated
+from src.util import get_config, get_zarr_store, s3_client
+
+# The intermediate store only lives for the duration of a rechunk, so it favours speed over ratio
+INTERMEDIATE_COMPRESSOR = Blosc(cname='lz4', clevel=1, shuffle=Blosc.SHUFFLE)
+
+# Rough peak memory of a task relative to the chunk it produces: the chunk being assembled plus the pieces it is
+# assembled from
+TASK_MEMORY_FACTOR = 2
+
+staging_dirs = []
+
+
+def _source_chunks(ds: xr.Dataset) -> Dict[str, int]:
+    # Largest chunk length of each dim across the data variables; unchunked variables count as one chunk
+    chunks = {}
+
+    for da in ds.data_vars.values():
+        for d, c in zip(da.dims, da.chunks if da.chunks is not None else da.shape):
+            chunks[d] = max(chunks.get(d, 0), max(c) if isinstance(c, tuple) else c)
+
+    return chunks
+
+
+def _chunk_bytes(ds: xr.Dataset, chunks: Dict[str, int]) -> int:
+    return max(
+        da.dtype.itemsize * math.prod(min(chunks.get(d, n), n) for d, n in zip(da.dims, da.shape))
+        for da in ds.data_vars.values()
+    )
+
+
+def _intermediate_encoding(da: xr.DataArray) -> dict:
+    # Masked integer variables keep their stored dtype in the intermediate store instead of being written as float
+    encoding = {'compressor': INTERMEDIATE_COMPRESSOR}
+    dtype = stored_dtype(da)
+
+    if dtype != da.dtype:
+        encoding.update(dtype=dtype, _FillValue=da.encoding['_FillValue'])
+
+    return encoding
+
+
+def _bounded(num_workers: int):
+    # A distributed cluster enforces its own worker memory limits; otherwise the local concurrency is limited
+    if dask.config.get('scheduler', None) == 'dask.distributed':
+        return nullcontext()
+
+    return dask.config.set(scheduler='threads', num_workers=num_workers)
+
+
+def rechunk_to_zarr(
+        ds: xr.Dataset,
+        target_chunks: Dict[str, int],
+        store,
+        encoding: Dict[str, dict],
+        max_mem: int,
+        temp_dir: Optional[str] = None,
+        mode: str = 'w-',
+) -> None:
+    # Writes ds to store with target_chunks in two phases through an intermediate local store, so neither phase needs
+    # an all-to-all rechunk graph:
+    #   1. every source chunk is split into intermediate chunks (the elementwise min of source and target chunks)
+    #   2. every target chunk is assembled from the intermediate chunks it covers
+    # Each task of either phase only holds one source or one target chunk, and the number of concurrent tasks is
+    # limited so they fit in max_mem.
+    source = _source_chunks(ds)
+    target = {d: target_chunks.get(d, c) for d, c in source.items()}
+    intermediate = {d: min(source[d], target[d]) for d in source}
+
+    read_bytes = TASK_MEMORY_FACTOR * _chunk_bytes(ds, source)
+    write_bytes = TASK_MEMORY_FACTOR * _chunk_bytes(ds, target)
+
+    if max(read_bytes, write_bytes) > max_mem:
+        raise ValueError(f'A single rechunk task needs up to {format_bytes(max(read_bytes, write_bytes))}, more than '
+                         f'the memory limit of {format_bytes(max_mem)}; raise the limit or use smaller chunks')
+
+    read_workers = max(1, max_mem // read_bytes)
+    write_workers = max(1, max_mem // write_bytes)
+
+    print(f'Rechunking {source} -> {intermediate} -> {target} within {format_bytes(max_mem)} '
+          f'({read_workers} concurrent split tasks, {write_workers} concurrent assemble tasks)')
+
+    temp_store = tempfile.mkdtemp(dir=temp_dir, prefix='rechunk-')
+
+    try:
+        start = time.perf_counter()
+
+        with _bounded(read_workers):
+            ds.chunk(intermediate).to_zarr(
+                temp_store,
+                mode='w',
+                encoding={vname: _intermediate_encoding(ds[vname]) for vname in ds.data_vars},
+                consolidated=True
+            )
+
+        print(f'Wrote intermediate store {temp_store} in {time.perf_counter() - start:.1f}s')
+
+        start = time.perf_counter()
+
+        with _bounded(write_workers):
+            write_consolidated(
+                xr.open_zarr(temp_store, chunks=target, consolidated=True),
+                store,
+                mode=mode,
+                encoding=encoding,
+                write_empty_chunks=False
+            )
+
+        print(f'Wrote rechunked store in {time.perf_counter() - start:.1f}s')
+    finally:
+        shutil.rmtree(temp_store, ignore_errors=True)
+
+
+def main(args):
+    config = get_config(args.config)
+
+    session = boto3.Session(profile_name=os.getenv('AWS_PROFILE', None))
+    credentials = None
+
+    if args.zarr.startswith('s3://') or args.output_s3 is not None:
+        credentials = session.get_credentials().get_frozen_credentials()
+
+    if args.zarr.startswith('s3://'):
+        client = s3_client(session)
+        store, stage_dir = get_zarr_store(args.zarr, args.zarr_access, client, credentials)
+
+        if stage_dir is not None:
+            staging_dirs.append(stage_dir)
+    else:
+        store = args.zarr
+
+    ds = xr.open_zarr(store, consolidated=True)
+
+    print(f'Opened zarr dataset at {args.zarr}')
+    print(ds)
+
+    codecs = load_codec_config(config)
+    chunk_config = config_chunks(config, ds, codecs)
+    out_path = output_store(args.output, args.output_s3, credentials)
+
+    print(f'Writing rechunked zarr file: {describe_store(out_path)}')
+
+    rechunk_to_zarr(
+        ds,
+        chunk_config,
+        out_path,
+        build_encoding(codecs, ds, source_fill_values(ds)),
+        args.max_memory,
+        args.temp_dir
+    )
+
+    empty_chunk_report(out_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rechunk an existing zarr store to the chunks of a config')
+
+    parser.add_argument(
+        'config',
+        nargs='?',
+        default=None,
+        help='Path to config file'
+    )
+
+    parser.add_argument(
+        '-z', '--zarr',
+        required=True,
+        help='S3 URL or local path of the zarr store to rechunk'
+    )
+
+    parser.add_argument(
+        '--zarr-access',
+        required=False,
+        default='stage',
+        choices=['stage', 'mount'],
+        help='stage: Download zarr data from S3 to local filesystem; mount: mount S3 to local filesystem'
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=parse_bytes,
+        required=True,
+        help='Memory budget for the rechunk (e.g., 8GB). Limits the number of chunks held in memory at once'
+    )
+
+    parser.add_argument(
+        '--temp-dir',
+        default=None,
+        help='Directory for the intermediate store (default: the system temp directory)'
+    )
+
+    parser.add_argument(
+        '--output-s3',
+        default=None,
+        help='S3 URL prefix to write the output zarr store to directly, instead of the local output directory. '
+             'Chunks are uploaded as they are computed and the consolidated metadata is written last'
+    )
+
+    parser.add_argument(
+        '-o', '--output',
+        required=True,
+        help='Output zarr filename'
+    )
+
+    add_execution_args(parser)
+
+    args = parser.parse_args()
+
+    print(args)
+
+    try:
+        with execution_context(args):
+            main(args)
+    finally:
+        for sd in staging_dirs:
+            try:
+                print(f'Cleaning up staging dir: {sd}')
+                shutil.rmtree(sd)
+            except:
+                print(f'Failed to remove staging dir: {sd}')
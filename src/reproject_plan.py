@@ -0,0 +1,286 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_reproject
+from pyproj import CRS as ProjCRS, Transformer
+
+# Resampling methods that can be expressed as a precomputed plan. Everything else is delegated to odc-geo/GDAL
+PLAN_RESAMPLING = {'nearest'}
+
+# Destination rows transformed per batch while building a plan, to bound the memory of the coordinate grids
+PLAN_ROW_BATCH = 256
+
+
+# Precomputed nearest-neighbour mapping from a source grid onto a window of a destination GeoBox. Only destination
+# pixels that land inside the source grid are stored, as flat indices into the window (dst_index) paired with flat
+# indices into the source array (src_index), so applying the plan is a single vectorized gather/scatter.
+class ReprojectionPlan:
+    def __init__(self, window: Tuple[int, int, int, int], src_shape: Tuple[int, int],
+                 dst_index: np.ndarray, src_index: np.ndarray):
+        self.window = window
+        self.src_shape = src_shape
+        self.dst_index = dst_index
+        self.src_index = src_index
+
+    @property
+    def nbytes(self) -> int:
+        return self.dst_index.nbytes + self.src_index.nbytes
+
+    @property
+    def slices(self) -> Tuple[slice, slice]:
+        r0, r1, c0, c1 = self.window
+        return slice(r0, r1), slice(c0, c1)
+
+    @property
+    def window_shape(self) -> Tuple[int, int]:
+        r0, r1, c0, c1 = self.window
+        return r1 - r0, c1 - c0
+
+    def apply(self, src: np.ndarray, dst_nodata, src_nodata=None) -> np.ndarray:
+        if src.shape != self.src_shape:
+            raise ValueError(f'Plan expects source shape {self.src_shape}, got {src.shape}')
+
+        values = src.reshape(-1)[self.src_index]
+
+        if src_nodata is not None:
+            invalid = np.isnan(values) if np.isnan(src_nodata) else values == src_nodata
+            values = np.where(invalid, dst_nodata, values)
+
+        out = np.full(self.window_shape, dst_nodata, dtype=src.dtype)
+        out.reshape(-1)[self.dst_index] = values
+
+        return out
+
+    def save(self, path: str):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+        os.close(fd)
+
+        np.savez(
+            tmp,
+            window=np.array(self.window),
+            src_shape=np.array(self.src_shape),
+            dst_index=self.dst_index,
+            src_index=self.src_index
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ReprojectionPlan':
+        with np.load(path) as data:
+            return cls(
+                tuple(int(v) for v in data['window']),
+                tuple(int(v) for v in data['src_shape']),
+                data['dst_index'],
+                data['src_index']
+            )
+
+    @classmethod
+    def build(cls, src_gbox: GeoBox, dst_gbox: GeoBox) -> 'ReprojectionPlan':
+        to_src = Transformer.from_crs(
+            ProjCRS.from_user_input(str(dst_gbox.crs)),
+            ProjCRS.from_user_input(str(src_gbox.crs)),
+            always_xy=True
+        )
+
+        r0, r1, c0, c1 = destination_window(src_gbox, dst_gbox)
+        width = c1 - c0
+        src_h, src_w = src_gbox.shape
+        dst_affine = dst_gbox.affine
+        src_inv = ~src_gbox.affine
+
+        index_dtype = np.int32 if max(src_h * src_w, (r1 - r0) * width) < 2 ** 31 else np.int64
+        cols = np.arange(c0, c1) + 0.5
+
+        dst_parts = []
+        src_parts = []
+
+        for batch_start in range(r0, r1, PLAN_ROW_BATCH):
+            rows = np.arange(batch_start, min(batch_start + PLAN_ROW_BATCH, r1)) + 0.5
+            cc, rr = np.meshgrid(cols, rows)
+
+            x = dst_affine.a * cc + dst_affine.b * rr + dst_affine.c
+            y = dst_affine.d * cc + dst_affine.e * rr + dst_affine.f
+
+            sx, sy = to_src.transform(x, y)
+
+            sc = np.floor(src_inv.a * sx + src_inv.b * sy + src_inv.c)
+            sr = np.floor(src_inv.d * sx + src_inv.e * sy + src_inv.f)
+
+            valid = np.isfinite(sc) & np.isfinite(sr) & (sc >= 0) & (sc < src_w) & (sr >= 0) & (sr < src_h)
+            valid_flat = np.flatnonzero(valid)
+
+            dst_parts.append((valid_flat + (batch_start - r0) * width).astype(index_dtype))
+            src_parts.append((sr.reshape(-1)[valid_flat] * src_w + sc.reshape(-1)[valid_flat]).astype(index_dtype))
+
+        return cls(
+            (r0, r1, c0, c1),
+            (src_h, src_w),
+            np.concatenate(dst_parts) if dst_parts else np.empty(0, dtype=index_dtype),
+            np.concatenate(src_parts) if src_parts else np.empty(0, dtype=index_dtype),
+        )
+
+
+def destination_window(src_gbox: GeoBox, dst_gbox: GeoBox, margin: int = 1) -> Tuple[int, int, int, int]:
+    # Row/column window of dst_gbox covered by the footprint of src_gbox, padded by margin pixels and clipped to the
+    # destination grid
+    footprint = src_gbox.extent.to_crs(dst_gbox.crs)
+    minx, miny, maxx, maxy = footprint.boundingbox
+
+    inv = ~dst_gbox.affine
+    corners = [inv * (x, y) for x in (minx, maxx) for y in (miny, maxy)]
+    cols = [c for c, _ in corners]
+    rows = [r for _, r in corners]
+
+    height, width = dst_gbox.shape
+
+    r0 = int(np.clip(np.floor(min(rows)) - margin, 0, height))
+    r1 = int(np.clip(np.ceil(max(rows)) + margin, 0, height))
+    c0 = int(np.clip(np.floor(min(cols)) - margin, 0, width))
+    c1 = int(np.clip(np.ceil(max(cols)) + margin, 0, width))
+
+    return r0, max(r0, r1), c0, max(c0, c1)
+
+
+def _plan_key(src_gbox: GeoBox, dst_gbox: GeoBox, resampling: str) -> str:
+    parts = (
+        str(src_gbox.crs), tuple(src_gbox.affine)[:6], tuple(src_gbox.shape),
+        str(dst_gbox.crs), tuple(dst_gbox.affine)[:6], tuple(dst_gbox.shape),
+        resampling
+    )
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+# Reprojection plans keyed by source geobox, destination geobox and resampling method. Plans are kept in memory up to
+# max_bytes (least recently used first out) and, if cache_dir is set, persisted to disk for reuse by later runs and
+# other worker processes.
+class PlanCache:
+    STAT_NAMES = ('hits', 'disk_hits', 'misses', 'fallbacks')
+
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._plans = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def stats(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.STAT_NAMES}
+
+    def add_stats(self, stats: Dict[str, int]):
+        with self._lock:
+            for name in self.STAT_NAMES:
+                setattr(self, name, getattr(self, name) + stats.get(name, 0))
+
+    def _remember(self, key: str, plan: ReprojectionPlan):
+        self._plans[key] = plan
+        self._bytes += plan.nbytes
+
+        while self._bytes > self.max_bytes and len(self._plans) > 1:
+            _, evicted = self._plans.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def get(self, src_gbox: GeoBox, dst_gbox: GeoBox, resampling: str) -> ReprojectionPlan:
+        key = _plan_key(src_gbox, dst_gbox, resampling)
+
+        with self._lock:
+            if key in self._plans:
+                self._plans.move_to_end(key)
+                self.hits += 1
+                return self._plans[key]
+
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, f'{key}.npz')
+
+        if path is not None and os.path.exists(path):
+            plan = ReprojectionPlan.load(path)
+            stat = 'disk_hits'
+        else:
+            plan = ReprojectionPlan.build(src_gbox, dst_gbox)
+            stat = 'misses'
+
+            if path is not None:
+                plan.save(path)
+
+        with self._lock:
+            setattr(self, stat, getattr(self, stat) + 1)
+            self._remember(key, plan)
+
+        return plan
+
+    def summary(self) -> str:
+        planned = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / planned if planned > 0 else 0.0
+
+        return (f'Reprojection plans: {self.hits:,} memory hits, {self.disk_hits:,} disk hits, {self.misses:,} built '
+                f'(hit rate {hit_rate:.1%}); {self.fallbacks:,} reprojections without a plan')
+
+
+_plan_caches = {}
+
+
+def get_plan_cache(cache_dir: Optional[str] = None) -> PlanCache:
+    # One cache per process and cache directory
+    if cache_dir not in _plan_caches:
+        _plan_caches[cache_dir] = PlanCache(cache_dir)
+
+    return _plan_caches[cache_dir]
+
+
+def plan_mismatches(tile: xr.Dataset, dst_gbox: GeoBox, nodata) -> Dict[str, Tuple[int, int]]:
+    # Warps tile onto the window of dst_gbox it covers both from a freshly built nearest-neighbour plan and with
+    # odc-geo/GDAL, and returns the number of differing pixels and the number of window pixels per variable
+    _, planned = warp_tile(tile, dst_gbox, 'nearest', nodata, PlanCache())
+    _, reference = warp_tile(tile, dst_gbox, 'nearest', nodata)
+
+    mismatches = {}
+
+    for name, values in planned.items():
+        same = values == reference[name]
+
+        if values.dtype.kind == 'f':
+            same |= np.isnan(values) & np.isnan(reference[name])
+
+        mismatches[name] = int(values.size - np.count_nonzero(same)), int(values.size)
+
+    return mismatches
+
+
+def warp_tile(
+        tile: xr.Dataset,
+        dst_gbox: GeoBox,
+        resampling: str,
+        nodata,
+        plan_cache: Optional[PlanCache] = None
+) -> Tuple[Tuple[slice, slice], Dict[str, np.ndarray]]:
+    # Warps a single tile onto the window of dst_gbox it covers. Returns the window and one array per variable, with
+    # nodata wherever the tile has no valid data
+    src_gbox = tile.odc.geobox
+
+    if plan_cache is not None and resampling in PLAN_RESAMPLING:
+        plan = plan_cache.get(src_gbox, dst_gbox, resampling)
+
+        return plan.slices, {
+            name: plan.apply(var.to_numpy(), nodata, var.rio.nodata) for name, var in tile.data_vars.items()
+        }
+
+    if plan_cache is not None:
+        plan_cache.add_stats({'fallbacks': 1})
+
+    r0, r1, c0, c1 = destination_window(src_gbox, dst_gbox)
+    warped = xr_reproject(src=tile, how=dst_gbox[r0:r1, c0:c1], resampling=resampling, dst_nodata=nodata)
+
+    return (slice(r0, r1), slice(c0, c1)), {name: var.to_numpy() for name, var in warped.data_vars.items()}
@@ -0,0 +1,152 @@
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
+
+import xarray as xr
+import zarr
+from botocore.credentials import Credentials
+from dask.utils import format_bytes
+from s3fs import S3Map
+
+from src.util import get_s3fs
+
+# Number of files uploaded concurrently by an Uploader. s3fs splits each file above its block size into a
+# multipart upload
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '16'))
+
+
+def output_url(output: str, output_s3: Optional[str]) -> Optional[str]:
+    # S3 URL of a zarr output named output, or None when it is written to local disk
+    if output_s3 is None:
+        return None
+
+    return f'{output_s3.rstrip("/")}/{output}'
+
+
+def output_store(output: str, output_s3: Optional[str], credentials: Optional[Credentials]) -> Union[str, S3Map]:
+    # Where a zarr output named output is written: output/<output> on local disk, or <output_s3>/<output> through
+    # the shared S3 filesystem, so chunks are uploaded as soon as they are computed
+    if output_s3 is None:
+        return os.path.join('output', output)
+
+    return S3Map(root=output_url(output, output_s3), s3=get_s3fs(credentials), check=False)
+
+
+def write_consolidated(ds: xr.Dataset, store: Union[str, S3Map], **kwargs):
+    # ds.to_zarr(store, **kwargs) with the consolidated metadata written last. xarray consolidates as soon as the
+    # array metadata is written, before any chunk, so readers of an S3 output would see the store as complete early
+    ds.to_zarr(store, consolidated=False, **kwargs)
+    zarr.consolidate_metadata(store)
+
+
+def describe_store(store: Union[str, S3Map]) -> str:
+    return store if isinstance(store, str) else f's3://{store.root}'
+
+
+def store_exists(store: Union[str, S3Map]) -> bool:
+    if isinstance(store, str):
+        return os.path.exists(store)
+
+    return '.zgroup' in store or '.zmetadata' in store
+
+
+def remove_store(store: Union[str, S3Map]):
+    if isinstance(store, str):
+        shutil.rmtree(store, ignore_errors=True)
+    else:
+        store.clear()
+
+
+class Uploader:
+    # Uploads local files to an S3 prefix from a thread pool while the caller keeps producing them, removing each
+    # local file once it is uploaded unless remove is False
+    def __init__(self, output_s3: str, credentials: Credentials, workers: int = UPLOAD_WORKERS, remove: bool = True):
+        self.prefix = output_s3.rstrip('/')
+        self.remove = remove
+        self.s3 = get_s3fs(credentials)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.futures: List[Future] = []
+        self.lock = threading.Lock()
+        self.uploaded = 0
+        self.uploaded_bytes = 0
+        self.start = time.perf_counter()
+
+    def _upload(self, path: str, key: Optional[str]) -> str:
+        url = f'{self.prefix}/{key if key is not None else os.path.basename(path)}'
+        size = os.path.getsize(path)
+
+        self.s3.put_file(path, url)
+
+        if self.remove:
+            os.remove(path)
+
+        with self.lock:
+            self.uploaded += 1
+            self.uploaded_bytes += size
+
+        return url
+
+    def submit(self, path: str, key: Optional[str] = None) -> Future:
+        # key is the path under the prefix to upload to; by default the file name
+        future = self.pool.submit(self._upload, path, key)
+        self.futures.append(future)
+        return future
+
+    def close(self):
+        # Waits for every upload and re-raises the first failure
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.pool.shutdown(wait=True)
+
+        elapsed = time.perf_counter() - self.start
+
+        print(f'Uploaded {self.uploaded:,} files ({format_bytes(self.uploaded_bytes)}) to {self.prefix} in '
+              f'{elapsed:,.2f}s: {format_bytes(int(self.uploaded_bytes / max(elapsed, 1e-9)))}/s')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def store_snapshot(path: str) -> Dict[str, Tuple[int, int]]:
+    # Size and modification time of every file of a local zarr store, by store key
+    snapshot = {}
+
+    for root, _, files in os.walk(path):
+        for filename in files:
+            file_path = os.path.join(root, filename)
+            stat = os.stat(file_path)
+            snapshot[os.path.relpath(file_path, path).replace(os.sep, '/')] = (stat.st_size, stat.st_mtime_ns)
+
+    return snapshot
+
+
+def upload_store_changes(path: str, before: Dict[str, Tuple[int, int]], url: str, credentials: Credentials):
+    # Mirrors the changes made to the local zarr store at path since the snapshot before onto the store at url:
+    # added and modified objects are uploaded and removed ones deleted, and the local store is left as it is. Chunks go
+    # first and metadata last, so readers of the remote store only see its new shape once the chunks behind it are in
+    # place
+    after = store_snapshot(path)
+    changed = [k for k, v in after.items() if before.get(k) != v]
+    removed = [k for k in before if k not in after]
+
+    def is_metadata(key):
+        return key.rsplit('/', 1)[-1].startswith('.z')
+
+    print(f'Uploading {len(changed):,} changed and deleting {len(removed):,} removed objects of {path} to {url}')
+
+    if len(removed) > 0:
+        get_s3fs(credentials).rm([f'{url.rstrip("/")}/{k}' for k in removed])
+
+    for metadata in (False, True):
+        with Uploader(url, credentials, remove=False) as uploader:
+            for key in changed:
+                if is_metadata(key) == metadata:
+                    uploader.submit(os.path.join(path, key), key)
@@ -0,0 +1,195 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from dask.utils import format_bytes, parse_bytes
+
+# Temporary files left behind by killed jobs are removed by eviction once they are this old
+STALE_TMP_AGE = 24 * 60 * 60
+
+
+@contextmanager
+def _flock(path: str):
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+# On-disk cache of staged S3 objects, content-addressed by bucket, key and ETag. Entries are shared between jobs on
+# the same node; entry creation and eviction are serialized with file locks. Entries are hard-linked (or copied across
+# filesystems) into the caller's staging directory, so removing a staging directory never touches the cache.
+class StagingCache:
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects_dir = os.path.join(root, 'objects')
+        self.lock_path = os.path.join(root, '.lock')
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self._stats_lock = threading.Lock()
+
+    def _entry_path(self, bucket: str, key: str, etag: str) -> str:
+        digest = hashlib.sha256(f'{bucket}/{key}/{etag}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    @staticmethod
+    def _link(src: str, dst: str):
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            os.remove(dst)
+            os.link(src, dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def _record(self, hit: bool, size: int):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+                self.hit_bytes += size
+            else:
+                self.misses += 1
+                self.miss_bytes += size
+
+    def fetch(self, bucket: str, obj: dict, dst: str, download: Callable[[str], int]) -> int:
+        path = self._entry_path(bucket, obj['Key'], obj['ETag'].strip('"'))
+
+        # Fast path: entry exists. It may be evicted by another job between the check and the link, in which case
+        # we fall through to the locked path below
+        if os.path.exists(path):
+            try:
+                os.utime(path)
+                self._link(path, dst)
+                size = os.path.getsize(dst)
+                self._record(True, size)
+                return size
+            except FileNotFoundError:
+                pass
+
+        entry_dir = os.path.dirname(path)
+        os.makedirs(entry_dir, exist_ok=True)
+
+        with _flock(f'{path}.lock'):
+            hit = os.path.exists(path)
+
+            if not hit:
+                fd, tmp = tempfile.mkstemp(dir=entry_dir, prefix=f'.{os.path.basename(path)}.')
+                os.close(fd)
+
+                try:
+                    download(tmp)
+                    os.chmod(tmp, 0o444)
+                    os.replace(tmp, path)
+                except BaseException:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                    raise
+            else:
+                os.utime(path)
+
+            self._link(path, dst)
+
+        size = os.path.getsize(dst)
+        self._record(hit, size)
+        return size
+
+    def evict(self):
+        with _flock(self.lock_path):
+            entries = []
+            total = 0
+            now = time.time()
+
+            for root, _, files in os.walk(self.objects_dir):
+                for filename in files:
+                    path = os.path.join(root, filename)
+
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+
+                    if filename.endswith('.lock'):
+                        # Lock files of evicted entries are removed with them; this catches those of downloads that
+                        # failed and never produced an entry
+                        if now - stat.st_mtime > STALE_TMP_AGE and not os.path.exists(path[:-len('.lock')]):
+                            os.remove(path)
+                        continue
+
+                    if filename.startswith('.'):
+                        if now - stat.st_mtime > STALE_TMP_AGE:
+                            os.remove(path)
+                        continue
+
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+
+            if total <= self.max_bytes:
+                return
+
+            entries.sort()
+
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+
+                total -= size
+
+                # Removing the lock of an entry being re-fetched at the same time can at worst cause a duplicate
+                # download; entries are only ever published by an atomic rename
+                try:
+                    os.remove(f'{path}.lock')
+                except FileNotFoundError:
+                    pass
+
+                with self._stats_lock:
+                    self.evictions += 1
+                    self.evicted_bytes += size
+
+    def summary(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0.0
+
+        return (f'Staging cache {self.root}: {self.hits:,} hits ({format_bytes(self.hit_bytes)}), '
+                f'{self.misses:,} misses ({format_bytes(self.miss_bytes)}), hit rate {hit_rate:.1%}, '
+                f'{self.evictions:,} evictions ({format_bytes(self.evicted_bytes)}), '
+                f'cap {format_bytes(self.max_bytes)}')
+
+
+_cache = None
+
+
+def get_staging_cache() -> Optional[StagingCache]:
+    global _cache
+
+    cache_dir = os.getenv('STAGE_CACHE_DIR')
+
+    if not cache_dir:
+        return None
+
+    if _cache is None or _cache.root != cache_dir:
+        _cache = StagingCache(cache_dir, parse_bytes(os.getenv('STAGE_CACHE_MAX_SIZE', '50GB')))
+        print(f'Using staging cache at {cache_dir} (cap {format_bytes(_cache.max_bytes)})')
+
+    return _cache
@@ -0,0 +1,70 @@
+import json
+import os
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+import rasterio
+from rasterio.warp import transform_bounds
+
+BBox = Tuple[float, float, float, float]
+
+
+def bbox_intersects(a: BBox, b: BBox) -> bool:
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def tiff_footprint(path: str) -> BBox:
+    # Opening the dataset only reads the header (CRS, transform and shape); no pixel data is decoded
+    with rasterio.open(path) as src:
+        return transform_bounds(src.crs, 'EPSG:4326', *src.bounds, densify_pts=21)
+
+
+def filter_tiffs(paths: List[str], bbox: BBox) -> List[str]:
+    kept = []
+    skipped_bytes = 0
+
+    for path in paths:
+        footprint = tiff_footprint(path)
+
+        if bbox_intersects(footprint, bbox):
+            kept.append(path)
+        else:
+            print(f'Skipping {os.path.basename(path)}: footprint {footprint} does not intersect bbox {bbox}')
+            skipped_bytes += os.path.getsize(path)
+
+    print(f'Spatial prefilter kept {len(kept):,} of {len(paths):,} tiffs; skipped {len(paths) - len(kept):,} tiffs '
+          f'({skipped_bytes / 1024 ** 2:,.1f} MiB)')
+
+    return kept
+
+
+def load_tile_footprints(path: str) -> Dict[str, BBox]:
+    # JSON object mapping tile IDs to [min_lon, min_lat, max_lon, max_lat]
+    with open(path) as fp:
+        return {tile_id: tuple(bounds) for tile_id, bounds in json.load(fp).items()}
+
+
+def tile_id_key_filter(
+        filename_pattern: str,
+        tile_id_group: str,
+        footprints: Dict[str, BBox],
+        bbox: BBox
+) -> Callable[[str], bool]:
+    # Filter for S3 keys that only uses the tile ID in the filename, so tiles outside the bbox are never staged. Keys
+    # that do not match the pattern or whose tile ID is not in the lookup table are kept
+    pattern = re.compile(filename_pattern)
+
+    def key_filter(key: str) -> bool:
+        match = pattern.match(os.path.basename(key))
+
+        if match is None:
+            return True
+
+        tile_id: Optional[str] = match.groupdict().get(tile_id_group)
+
+        if tile_id is None or tile_id not in footprints:
+            return True
+
+        return bbox_intersects(footprints[tile_id], bbox)
+
+    return key_filter
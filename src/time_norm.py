@@ -0,0 +1,172 @@
+import argparse
+import os
+import sys
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(SCRIPT_DIR))
+
+# Which of a set of duplicate time steps is kept: the one that comes first or last in input order
+KEEP_POLICIES = ('first', 'last')
+
+
+def time_selection(
+        times: np.ndarray,
+        keep: str = 'first',
+        duration: Optional[pd.Timedelta] = None
+) -> Tuple[np.ndarray, int, int]:
+    # Returns the positions into times that sort it, drop duplicates according to keep and retain only the steps
+    # within duration of the last one, along with the number of duplicate and trimmed steps. Everything is done on the
+    # raw int64 representation of the time axis.
+    if keep not in KEEP_POLICIES:
+        raise ValueError(f'Unsupported keep policy {keep!r}; expected one of {KEEP_POLICIES}')
+
+    t = np.asarray(times).astype('datetime64[ns]').view('int64')
+
+    order = np.argsort(t, kind='stable')
+    sorted_t = t[order]
+
+    if keep == 'first':
+        _, pos = np.unique(sorted_t, return_index=True)
+    else:
+        _, pos = np.unique(sorted_t[::-1], return_index=True)
+        pos = len(sorted_t) - 1 - pos
+
+    indices = order[pos]
+    kept_t = sorted_t[pos]
+    n_duplicates = len(t) - len(indices)
+    n_trimmed = 0
+
+    if duration is not None and len(kept_t) > 0:
+        start = int(np.searchsorted(kept_t, kept_t[-1] - pd.Timedelta(duration).value, side='left'))
+        indices = indices[start:]
+        n_trimmed = start
+
+    return indices, n_duplicates, n_trimmed
+
+
+def normalize_time(
+        ds: xr.Dataset,
+        dim: str,
+        time_coord: str,
+        keep: str = 'first',
+        duration: Optional[pd.Timedelta] = None
+) -> xr.Dataset:
+    # Sorts ds along dim, drops duplicate time steps and trims it to duration, applied as a single isel
+    times = ds[time_coord].to_numpy()
+    indices, n_duplicates, n_trimmed = time_selection(times, keep, duration)
+
+    if n_duplicates > 0:
+        print(f'Warning: dropping {n_duplicates:,} duplicate time steps (keeping {keep})')
+
+    if n_trimmed > 0:
+        print(f'Dataset duration exceeds max duration provided; dropping {n_trimmed:,} time steps')
+
+    if len(indices) == len(times) and np.all(np.diff(indices) > 0):
+        return ds
+
+    ds = ds.isel({dim: indices})
+
+    if len(indices) > 0:
+        kept = ds[time_coord].to_numpy()
+        print(f'New dataset duration: {pd.Timedelta(kept[-1] - kept[0])}')
+
+    return ds
+
+
+def _legacy_normalize(ds: xr.Dataset, dim: str, time_coord: str, duration: pd.Timedelta) -> xr.Dataset:
+    # The per-step loops previously used by the writers, kept for comparison in the benchmark
+    ds = ds.sortby(dim)
+    times = ds[time_coord].to_numpy()
+
+    if any(np.diff(times).astype(int) == 0):
+        prev = None
+        drop = []
+
+        for i, v in enumerate(times.astype(int)):
+            if v == prev:
+                drop.append(i - 1)
+
+            prev = v
+
+        ds = ds.drop_duplicates(dim=dim, keep='first')
+
+    idx = 0
+
+    while pd.Timedelta((ds[time_coord][-1] - ds[time_coord][idx]).data.item()) > duration:
+        idx += 1
+
+    return ds.isel({dim: slice(idx, None)})
+
+
+def benchmark(years: int, duplicate_fraction: float, duration: pd.Timedelta, repeat: int):
+    rng = np.random.default_rng(0)
+
+    times = pd.date_range('2000-01-01', periods=years * 365 * 24, freq='h').to_numpy()
+    duplicates = rng.choice(times, int(len(times) * duplicate_fraction), replace=False)
+    times = np.concatenate([times, duplicates])
+    rng.shuffle(times)
+
+    ds = xr.Dataset(coords={'time': times})
+
+    print(f'Benchmarking {len(times):,} hourly time steps ({years} years, {len(duplicates):,} duplicates), '
+          f'duration {duration}')
+
+    start = time.perf_counter()
+    legacy = _legacy_normalize(ds, 'time', 'time', duration)
+    legacy_s = time.perf_counter() - start
+
+    vectorized_s = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        indices, _, _ = time_selection(ds['time'].to_numpy(), 'first', duration)
+        vectorized = ds.isel(time=indices)
+        vectorized_s.append(time.perf_counter() - start)
+
+    assert np.array_equal(legacy['time'].to_numpy(), vectorized['time'].to_numpy())
+
+    print(f'  legacy loops: {legacy_s * 1000:,.1f} ms')
+    print(f'  vectorized:   {min(vectorized_s) * 1000:,.1f} ms (best of {repeat})')
+    print(f'  speedup:      {legacy_s / min(vectorized_s):,.0f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of time axis normalization')
+
+    parser.add_argument(
+        '--years',
+        type=int,
+        default=5,
+        help='Length of the synthetic hourly time axis in years'
+    )
+
+    parser.add_argument(
+        '--duplicates',
+        type=float,
+        default=0.01,
+        help='Fraction of time steps that are duplicated'
+    )
+
+    parser.add_argument(
+        '-d', '--duration',
+        type=pd.Timedelta,
+        default=pd.Timedelta('P30D'),
+        help='Max duration to trim to'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='Number of timed runs of the vectorized path'
+    )
+
+    args = parser.parse_args()
+
+    benchmark(args.years, args.duplicates, args.duration, args.repeat)
@@ -1,18 +1,50 @@
+import itertools
 import json
 import os
+import random
 import tempfile
-from typing import Optional, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from urllib.parse import urlparse
 
+import numpy as np
+import pandas as pd
 import xarray as xr
 import yamale
 import yaml
+from boto3.exceptions import RetriesExceededError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.credentials import Credentials
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 from s3fs import S3FileSystem, S3Map
 
+from src.staging_cache import get_staging_cache
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 SCHEMA_PATH = os.path.join(SCRIPT_DIR, 'schema', 'dataset_schema.yaml')
 
+# Staging tunables. Up to STAGE_WORKERS * STAGE_PART_CONCURRENCY ranged GETs run at once, so clients created with
+# s3_client get a connection pool of that size.
+STAGE_WORKERS = int(os.getenv('STAGE_WORKERS', '10'))
+STAGE_MAX_ATTEMPTS = int(os.getenv('STAGE_MAX_ATTEMPTS', '5'))
+STAGE_BACKOFF_BASE = float(os.getenv('STAGE_BACKOFF_BASE', '0.5'))
+STAGE_MULTIPART_THRESHOLD = int(os.getenv('STAGE_MULTIPART_THRESHOLD', str(64 * 1024 ** 2)))
+STAGE_MULTIPART_CHUNKSIZE = int(os.getenv('STAGE_MULTIPART_CHUNKSIZE', str(16 * 1024 ** 2)))
+STAGE_PART_CONCURRENCY = int(os.getenv('STAGE_PART_CONCURRENCY', '4'))
+
+# Connection pool size of the shared S3 filesystem used when mounting stores, and the number of stores whose metadata
+# is opened concurrently
+S3FS_MAX_POOL_CONNECTIONS = int(os.getenv('S3FS_MAX_POOL_CONNECTIONS', '64'))
+OPEN_WORKERS = int(os.getenv('OPEN_WORKERS', '32'))
+
+RETRYABLE_ERROR_CODES = {
+    'RequestTimeout', 'RequestTimeoutException', 'SlowDown', 'Throttling', 'ThrottlingException',
+    'InternalError', 'ServiceUnavailable', '500', '502', '503', '504'
+}
+
 
 DEFAULT_CONFIG = {
     'chunks': {
@@ -55,12 +87,111 @@ def get_config(path: str) -> dict:
 
         config['coordinates'] = config_data.get('coordinates', config['dimensions'])
 
+        for key in ('chunk_target', 'codecs', 'precision'):
+            if key in config_data:
+                config[key] = config_data[key]
+
     print(f'Final config:\n{json.dumps(config, indent=2)}')
 
     return config
 
 
-def stage_s3(prefix_url: str, client) -> str:
+def s3_client(session):
+    # S3 client whose connection pool fits every concurrent staging download
+    return session.client('s3', config=Config(max_pool_connections=STAGE_WORKERS * STAGE_PART_CONCURRENCY))
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code') in RETRYABLE_ERROR_CODES
+
+    return isinstance(e, (BotoConnectionError, HTTPClientError, RetriesExceededError))
+
+
+def _download_object(client, bucket: str, key: str, dst: str, transfer_config: TransferConfig) -> int:
+    for attempt in range(1, STAGE_MAX_ATTEMPTS + 1):
+        try:
+            client.download_file(bucket, key, dst, Config=transfer_config)
+            return os.path.getsize(dst)
+        except Exception as e:
+            if attempt == STAGE_MAX_ATTEMPTS or not _is_transient(e):
+                raise
+
+            delay = STAGE_BACKOFF_BASE * (2 ** (attempt - 1)) * (1 + random.random())
+            print(f'Transient error downloading s3://{bucket}/{key} (attempt {attempt}/{STAGE_MAX_ATTEMPTS}): {e}; '
+                  f'retrying in {delay:.1f}s')
+            time.sleep(delay)
+
+
+def _list_objects(client, bucket: str, prefix: str) -> List[dict]:
+    paginator = client.get_paginator('list_objects_v2')
+    objects = []
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            # Listings already carry the object size, so directory markers can be identified without a HEAD request
+            if obj['Key'].endswith('/') and obj['Size'] == 0:
+                print(f'Skipping directory object {obj["Key"]}')
+                continue
+
+            objects.append(obj)
+
+    return objects
+
+
+def _stage_object(client, bucket: str, obj: dict, dst: str, transfer_config: TransferConfig, cache) -> int:
+    if cache is None:
+        return _download_object(client, bucket, obj['Key'], dst, transfer_config)
+
+    return cache.fetch(
+        bucket, obj, dst, lambda path: _download_object(client, bucket, obj['Key'], path, transfer_config)
+    )
+
+
+def _download_objects(client, bucket: str, jobs: List[Tuple[dict, str]], workers: int = STAGE_WORKERS):
+    cache = get_staging_cache()
+    transfer_config = TransferConfig(
+        multipart_threshold=STAGE_MULTIPART_THRESHOLD,
+        multipart_chunksize=STAGE_MULTIPART_CHUNKSIZE,
+        max_concurrency=STAGE_PART_CONCURRENCY,
+    )
+
+    for _, dst in jobs:
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+    total_bytes = 0
+    start = time.perf_counter()
+
+    print(f'Downloading {len(jobs):,} objects from s3://{bucket} with {workers} workers')
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(_stage_object, client, bucket, obj, dst, transfer_config, cache): (obj, dst)
+            for obj, dst in jobs
+        }
+
+        for i, future in enumerate(as_completed(futures), start=1):
+            obj, dst = futures[future]
+            total_bytes += future.result()
+
+            print(f'[{i:,}/{len(jobs):,}] Staged s3://{bucket}/{obj["Key"]} to {dst}')
+
+    elapsed = time.perf_counter() - start
+
+    print(f'Staged {len(jobs):,} objects ({total_bytes / 1024 ** 2:,.1f} MiB) in {elapsed:,.2f}s '
+          f'({total_bytes / 1024 ** 2 / max(elapsed, 1e-9):,.1f} MiB/s)')
+
+    if cache is not None:
+        cache.evict()
+        print(cache.summary())
+
+
+def stage_s3(
+        prefix_url: str,
+        client,
+        workers: int = STAGE_WORKERS,
+        key_filter: Optional[Callable[[str], bool]] = None
+) -> str:
     staging_dir = tempfile.mkdtemp()
 
     print(f'Created data staging directory: {staging_dir}')
@@ -79,43 +210,269 @@ def stage_s3(prefix_url: str, client) -> str:
     else:
         strip_prefix = prefix
 
-    paginator = client.get_paginator('list_objects_v2')
+    objects = _list_objects(client, bucket, prefix)
+
+    if key_filter is not None:
+        kept = [obj for obj in objects if key_filter(obj['Key'])]
+        skipped_bytes = sum(obj['Size'] for obj in objects) - sum(obj['Size'] for obj in kept)
+
+        print(f'Key filter skipped {len(objects) - len(kept):,} of {len(objects):,} objects '
+              f'({skipped_bytes / 1024 ** 2:,.1f} MiB)')
+
+        objects = kept
+
+    jobs = [(obj, os.path.join(staging_dir, obj['Key'].removeprefix(strip_prefix))) for obj in objects]
+
+    _download_objects(client, bucket, jobs, workers)
+
+    return staging_dir
+
+
+def _selection_slice(values: np.ndarray, start, stop) -> slice:
+    # Label-based [start, stop] selection on a 1D coordinate that may be ascending or descending
+    if values.dtype.kind == 'M':
+        start = None if start is None else pd.Timestamp(start).to_datetime64()
+        stop = None if stop is None else pd.Timestamp(stop).to_datetime64()
+
+    mask = np.ones(len(values), dtype=bool)
+
+    if start is not None:
+        mask &= values >= start
+    if stop is not None:
+        mask &= values <= stop
+
+    indices = np.flatnonzero(mask)
+
+    if len(indices) == 0:
+        return slice(0, 0)
+
+    return slice(int(indices[0]), int(indices[-1]) + 1)
+
+
+def subset_dataset(ds: xr.Dataset, variables: Optional[List[str]], selection: Optional[Dict[str, tuple]]) -> xr.Dataset:
+    if variables is not None:
+        ds = ds[variables]
+
+    if selection:
+        ds = ds.isel({dim: _selection_slice(ds[dim].to_numpy(), *bounds) for dim, bounds in selection.items()})
+
+    return ds
 
-    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        for obj in [o['Key'] for o in page.get('Contents', [])]:
-            if obj.endswith('/'):
-                head = client.head_object(Bucket=bucket, Key=obj)
 
-                if head['ContentLength'] == 0:
-                    print(f'Skipping directory object {obj}')
-                    continue
+def _chunk_keys(name: str, zarray: dict, dims: List[str], slices: Dict[str, slice]) -> List[str]:
+    separator = zarray.get('dimension_separator') or '.'
 
-            dst = os.path.join(staging_dir, obj.removeprefix(strip_prefix))
-            os.makedirs(os.path.dirname(dst), exist_ok=True)
-            print(f'Downloading s3://{bucket}/{obj} to {dst}')
-            client.download_file(bucket, obj, dst)
+    if len(zarray['shape']) == 0:
+        return [f'{name}/0']
+
+    ranges = []
+
+    for dim, size, chunk in zip(dims, zarray['shape'], zarray['chunks']):
+        s = slices.get(dim, slice(0, size))
+
+        if s.stop <= s.start:
+            return []
+
+        ranges.append(range(s.start // chunk, (s.stop - 1) // chunk + 1))
+
+    return [f'{name}/{separator.join(str(i) for i in idx)}' for idx in itertools.product(*ranges)]
+
+
+def stage_zarr_subset(
+        zarr_url: str,
+        client,
+        variables: Optional[List[str]] = None,
+        selection: Optional[Dict[str, tuple]] = None,
+        workers: int = STAGE_WORKERS,
+        tail: Optional[str] = None
+) -> str:
+    # Stages the metadata and coordinates of a consolidated store, and the data chunks of variables that intersect
+    # selection. If tail names a dim, only the trailing partial chunk of each variable along it is staged (nothing if
+    # its last chunk is full), which is all an append along that dim rewrites.
+    staging_dir = tempfile.mkdtemp()
+
+    print(f'Created data staging directory: {staging_dir}')
+
+    parsed_url = urlparse(zarr_url.rstrip('/'))
+
+    if parsed_url.scheme != 's3':
+        raise ValueError(f'Expected s3 URL, got {parsed_url.scheme}')
+
+    bucket = parsed_url.netloc
+    store_prefix = parsed_url.path.strip('/')
+    zarr_dir = os.path.join(staging_dir, os.path.basename(store_prefix))
+
+    metadata = json.loads(
+        client.get_object(Bucket=bucket, Key=f'{store_prefix}/.zmetadata')['Body'].read()
+    )['metadata']
+
+    arrays = {}
+
+    for meta_key, zarray in metadata.items():
+        if meta_key.endswith('/.zarray'):
+            name = meta_key[:-len('/.zarray')]
+            zattrs = metadata.get(f'{name}/.zattrs', {})
+            arrays[name] = (zarray, zattrs.get('_ARRAY_DIMENSIONS', []), zattrs)
+
+    coordinates = set(metadata.get('.zattrs', {}).get('coordinates', '').split())
+    data_vars = [n for n, (_, dims, _) in arrays.items() if len(dims) > 0 and n not in dims and n not in coordinates]
+
+    if variables is None:
+        variables = data_vars
+
+    missing = [v for v in variables if v not in arrays]
+
+    if len(missing) > 0:
+        raise ValueError(f'Variables {missing} not found in {zarr_url}')
+
+    for v in variables:
+        coordinates.update(arrays[v][2].get('coordinates', '').split())
+
+    # Everything that is not a data variable (dimension coordinates, auxiliary coordinates, scalar CRS variables) is
+    # small and is staged in full alongside the metadata
+    full_arrays = {n for n in arrays if n not in data_vars or n in coordinates}
+
+    objects = _list_objects(client, bucket, f'{store_prefix}/')
+
+    def rel_key(obj):
+        return obj['Key'][len(store_prefix) + 1:]
+
+    def job(obj):
+        return obj, os.path.join(zarr_dir, rel_key(obj))
+
+    print(f'Staging metadata and {len(full_arrays)} coordinate arrays from {zarr_url}')
+
+    _download_objects(
+        client,
+        bucket,
+        [job(o) for o in objects
+         if os.path.basename(rel_key(o)).startswith('.z') or rel_key(o).split('/')[0] in full_arrays],
+        workers
+    )
+
+    slices = {}
+
+    if selection:
+        with xr.open_zarr(zarr_dir, consolidated=True) as coord_ds:
+            for dim, bounds in selection.items():
+                slices[dim] = _selection_slice(coord_ds[dim].to_numpy(), *bounds)
+                print(f'Selection {dim}={bounds} maps to index range [{slices[dim].start}, {slices[dim].stop})')
+
+    needed = set()
+
+    for v in variables:
+        if v in full_arrays:
+            continue
+
+        zarray, dims, _ = arrays[v]
+        var_slices = slices
+
+        if tail in dims:
+            size, chunk = zarray['shape'][dims.index(tail)], zarray['chunks'][dims.index(tail)]
+            var_slices = {**slices, tail: slice(size - size % chunk, size)}
+
+        needed.update(_chunk_keys(v, zarray, dims, var_slices))
+
+    chunk_objects = [o for o in objects if rel_key(o) in needed]
+    total_chunks = sum(1 for o in objects if rel_key(o).split('/')[0] in data_vars
+                       and not os.path.basename(rel_key(o)).startswith('.z'))
+
+    print(f'Staging {len(chunk_objects):,} of {total_chunks:,} stored data chunks for variables {variables} '
+          f'({sum(o["Size"] for o in chunk_objects) / 1024 ** 2:,.1f} MiB)')
+
+    _download_objects(client, bucket, [job(o) for o in chunk_objects], workers)
 
     return staging_dir
 
 
-def open_zarr(zarr_url: str, method: str, client, credentials: Credentials) -> Tuple[xr.Dataset, Optional[str]]:
+@lru_cache(maxsize=None)
+def _s3fs(key: str, secret: str, token: Optional[str]) -> S3FileSystem:
+    return S3FileSystem(
+        False,
+        key=key,
+        secret=secret,
+        token=token,
+        client_kwargs=dict(region_name='us-west-2', endpoint_url=os.getenv('AWS_ENDPOINT_URL')),
+        config_kwargs=dict(max_pool_connections=S3FS_MAX_POOL_CONNECTIONS)
+    )
+
+
+def get_s3fs(credentials: Credentials) -> S3FileSystem:
+    # One pooled filesystem per set of credentials, shared by every mounted store and S3 output in the process.
+    # AWS_ENDPOINT_URL points it at an S3-compatible endpoint (e.g. a local moto server)
+    return _s3fs(credentials.access_key, credentials.secret_key, credentials.token)
+
+
+def get_zarr_store(
+        zarr_url: str,
+        method: str,
+        client,
+        credentials: Credentials,
+        variables: Optional[List[str]] = None,
+        selection: Optional[Dict[str, tuple]] = None,
+        tail: Optional[str] = None,
+) -> Tuple[Union[str, S3Map], Optional[str]]:
     if method == 'stage':
-        print('Staging zarr data to local')
-        local_dir = stage_s3(zarr_url.rstrip('/'), client)
-        zarr_dir = os.path.join(local_dir, os.path.basename(zarr_url.rstrip('/')))
+        if variables is None and not selection and tail is None:
+            print('Staging zarr data to local')
+            local_dir = stage_s3(zarr_url.rstrip('/'), client)
+        else:
+            print(f'Staging zarr data subset to local (variables={variables}, selection={selection}, tail={tail})')
+            local_dir = stage_zarr_subset(zarr_url, client, variables, selection, tail=tail)
 
-        print(f'Opening staged zarr data at {zarr_dir}')
-        return xr.open_zarr(zarr_dir, consolidated=True), local_dir
+        return os.path.join(local_dir, os.path.basename(zarr_url.rstrip('/'))), local_dir
     elif method == 'mount':
-        s3 = S3FileSystem(
-            False,
-            key=credentials.access_key,
-            secret=credentials.secret_key,
-            token=credentials.token,
-            client_kwargs=dict(region_name='us-west-2')
-        )
-
-        store = S3Map(root=zarr_url, s3=s3, check=False)
-        return xr.open_zarr(store, consolidated=True), None
+        return S3Map(root=zarr_url, s3=get_s3fs(credentials), check=False), None
     else:
         raise ValueError(f'Unsupported zarr open method: {method}')
+
+
+def open_zarr(
+        zarr_url: str,
+        method: str,
+        client,
+        credentials: Credentials,
+        variables: Optional[List[str]] = None,
+        selection: Optional[Dict[str, tuple]] = None,
+) -> Tuple[xr.Dataset, Optional[str]]:
+    # variables and selection (dim -> inclusive (start, stop) label bounds, either may be None) restrict the returned
+    # dataset. When staging, only the chunks they intersect are downloaded.
+    store, local_dir = get_zarr_store(zarr_url, method, client, credentials, variables, selection)
+
+    if local_dir is not None:
+        print(f'Opening staged zarr data at {store}')
+
+    return subset_dataset(xr.open_zarr(store, consolidated=True), variables, selection), local_dir
+
+
+def open_zarr_metadata(
+        zarr_urls: List[str],
+        credentials: Credentials,
+        workers: int = OPEN_WORKERS
+) -> Dict[str, xr.Dataset]:
+    # Opens many stores lazily through the shared S3 filesystem, fetching their consolidated metadata (and index
+    # coordinates) concurrently
+    def _open(url):
+        start = time.perf_counter()
+        ds = xr.open_zarr(S3Map(root=url, s3=get_s3fs(credentials), check=False), consolidated=True)
+        return url, ds, time.perf_counter() - start
+
+    if len(zarr_urls) == 0:
+        return {}
+
+    datasets = {}
+    latencies = []
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(zarr_urls)))) as pool:
+        for url, ds, latency in pool.map(_open, zarr_urls):
+            print(f'Opened {url} in {latency:.2f}s')
+            datasets[url] = ds
+            latencies.append(latency)
+
+    elapsed = time.perf_counter() - start
+
+    print(f'Opened {len(datasets):,} zarr stores in {elapsed:.2f}s with {workers} workers '
+          f'(latency mean {np.mean(latencies):.2f}s, max {np.max(latencies):.2f}s, sum {np.sum(latencies):.2f}s)')
+
+    return datasets
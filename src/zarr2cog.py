@@ -1,78 +1,308 @@
 import argparse
+import json
+import math
+import multiprocessing
 import os
 import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
 
 import boto3
+import pandas as pd
+import rioxarray  # noqa: F401 (registers the .rio accessor)
+import xarray as xr
+from dask.utils import parse_bytes
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from src.util import open_zarr
+from src.codec_config import stored_dtype
+from src.cog_profiles import benchmark_presets, load_cog_profiles
+from src.execution import add_execution_args, configure_worker, execution_context
+from src.s3_output import Uploader
+from src.util import get_zarr_store, s3_client, subset_dataset
 
 staging_dirs = []
 
-# TODO: Permit user to define these
-DRIVER_KWARGS = {}
-DRIVER_OPTIONS = [
-    'blocksize', 'compress', 'level', 'max_z_error', 'max_z_error_overview', 'quality', 'jxl_lossless',
-    'jxl_effort', 'jxl_distance', 'jxl_alpha_distance', 'num_threads', 'nbits', 'predictor', 'bigtiff',
-    'resampling', 'overview_resampling', 'warp_resampling', 'overviews', 'overview_count', 'overview_compress',
-    'overview_quality', 'overview_predictor', 'geotiff_version', 'sparse_ok', 'statistics', 'tiling_scheme',
-    'zoom_level', 'zoom_level_strategy', 'target_srs', 'res', 'extent', 'aligned_levels', 'add_alpha'
-]
+# Per-process export state, set by _init_worker
+_worker_ds = None
+_worker_args = None
+_worker_profiles = None
+_worker_vars = {}
+
+
+def _init_worker(store, args, profiles):
+    global _worker_ds, _worker_args, _worker_profiles
+
+    _worker_ds = subset_dataset(xr.open_zarr(store, consolidated=True), args.variables, _get_selection(args))
+    _worker_args = args
+    _worker_profiles = profiles
+    _worker_vars.clear()
+
+
+def _init_pool_worker(store, args, profiles):
+    configure_worker(args.threads_per_worker)
+    _init_worker(store, args, profiles)
+
+
+def _prepare_variable(var_name: str) -> xr.DataArray:
+    # CRS, spatial dim names, attribute names and latitude orientation are set up once per variable (and process)
+    if var_name in _worker_vars:
+        return _worker_vars[var_name]
+
+    args = _worker_args
+    lat_c = args.latitude
+    lon_c = args.longitude
+
+    data = _worker_ds[var_name]
+    data = data.rio.write_crs("epsg:4326")
+    # TODO: For set_spatial_dims should I determine the dim name instead of using the coord name?
+    # data = data.rio.set_spatial_dims(x_dim=lon_c, y_dim=lat_c)
+    data = data.rename({lon_c: 'x', lat_c: 'y'})
+    data.attrs = {k.upper(): v for k, v in data.attrs.items()}
+
+    # Masking an integer variable's fill value decodes it to float with NaN. Export it with its stored dtype and the
+    # fill value as nodata instead; packed variables keep their decoded values
+    dtype = stored_dtype(data)
+
+    if dtype != data.dtype:
+        fill_value = data.encoding['_FillValue']
+        data = data.fillna(fill_value).astype(dtype).rio.write_nodata(fill_value)
+
+    try:
+        latitude = data['y'].to_numpy()
+
+        if latitude[1] - latitude[0] >= 0:
+            print(f'Flipping latitude for {var_name}')
+            data = data.isel({'y': slice(None, None, -1)})
+    except Exception as e:
+        print(f'Could not check latitude ordering for {var_name} due to {e}')
+
+    _worker_vars[var_name] = data
+    return data
+
+
+def _get_selection(args) -> Dict[str, tuple]:
+    selection = {}
+
+    if args.start is not None or args.end is not None:
+        selection[args.time] = (args.start, args.end)
+
+    if args.bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = args.bbox
+        selection[args.longitude] = (min_lon, max_lon)
+        selection[args.latitude] = (min_lat, max_lat)
+
+    return selection
+
+
+def _cog_filename(prefix: str, dt: datetime, var_name: str) -> str:
+    return f'{prefix}_{dt.strftime("%Y-%m-%dT%H%M%SZ")}_{var_name}.tif'
+
+
+def _read_manifest(url: str, client) -> List[str]:
+    parsed_url = urlparse(url)
+
+    if parsed_url.scheme == 's3':
+        body = client.get_object(Bucket=parsed_url.netloc, Key=parsed_url.path.lstrip('/'))['Body'].read()
+        entries = json.loads(body)
+    else:
+        with open(url) as fp:
+            entries = json.load(fp)
+
+    return [os.path.basename(e) for e in entries]
+
+
+def _time_chunks(da: xr.DataArray, time_dim: str) -> List[Tuple[int, int]]:
+    if da.chunks is not None:
+        sizes = da.chunksizes[time_dim]
+    else:
+        sizes = [da.encoding.get('chunks', (da.sizes[time_dim],))[da.get_axis_num(time_dim)]] * da.sizes[time_dim]
+
+    bounds = []
+    start = 0
+
+    for size in sizes:
+        stop = min(start + size, da.sizes[time_dim])
+        bounds.append((start, stop))
+        start = stop
+
+        if start >= da.sizes[time_dim]:
+            break
+
+    return bounds
+
+
+def _export_time_chunk(var_name: str, indices: List[int]) -> List[Tuple[str, int]]:
+    args = _worker_args
+    da = _prepare_variable(var_name)
+    time_dim = da[args.time].dims[0]
+
+    # Decode as many time steps of the zarr chunk(s) at once as fit in this worker's share of the memory budget, and
+    # emit every step of a block from memory. A spatially huge chunk is read one time step at a time
+    slice_bytes = da.dtype.itemsize * math.prod(n for d, n in da.sizes.items() if d != time_dim)
+    steps = max(1, args.max_memory // max(1, args.pool_workers) // max(1, slice_bytes))
+
+    blocks = []
+
+    for i in indices:
+        if len(blocks) > 0 and i - blocks[-1][0] < steps:
+            blocks[-1].append(i)
+        else:
+            blocks.append([i])
+
+    driver_kwargs = _worker_profiles.for_variable(var_name)
+    written = []
+
+    for block_indices in blocks:
+        start = block_indices[0]
+        block = da.isel({time_dim: slice(start, block_indices[-1] + 1)}).load()
+
+        for i in block_indices:
+            data = block.isel({time_dim: i - start})
+            dt = data[args.time].values.astype('datetime64[s]').item()
+
+            out_path = os.path.join('output', _cog_filename(args.output, dt, var_name))
+
+            print(f'Writing timestep {dt} to {out_path}')
+
+            data.rio.to_raster(out_path, driver='COG', sharing=False, **driver_kwargs)
+
+            written.append((out_path, os.path.getsize(out_path)))
+
+        del block
+
+    return written
 
 
 def main(args):
     zarr_url = args.zarr
     time_c = args.time
-    lat_c = args.latitude
-    lon_c = args.longitude
 
     session = boto3.Session(profile_name=os.getenv('AWS_PROFILE', None))
-    client = session.client('s3')
+    client = s3_client(session)
     credentials = session.get_credentials().get_frozen_credentials()
 
-    ds, stage_dir = open_zarr(zarr_url, args.zarr_access, client, credentials)
+    # Variable, time and spatial subsets are pushed down into staging so only the chunks they touch are fetched
+    store, stage_dir = get_zarr_store(
+        zarr_url,
+        args.zarr_access,
+        client,
+        credentials,
+        variables=args.variables,
+        selection=_get_selection(args)
+    )
 
     if stage_dir is not None:
         staging_dirs.append(stage_dir)
 
+    profiles = load_cog_profiles(args.cog_profile)
+
+    _init_worker(store, args, profiles)
+    ds = _worker_ds
+
     print(f'Opened zarr dataset at {zarr_url}')
     print(ds)
 
     print(f'{len(ds.data_vars)} variables, {len(ds[time_c])} time steps')
 
-    for var_name in ds.data_vars:
-        print(f'Iterating over variable {var_name}')
+    if args.benchmark_profiles:
+        for var_name in ds.data_vars:
+            da = _prepare_variable(var_name)
+            benchmark_presets(da.isel({da[time_c].dims[0]: 0}).load(), var_name)
+
+        return
+
+    existing = set()
+
+    if args.skip_manifest is not None:
+        existing = set(_read_manifest(args.skip_manifest, client))
+        print(f'Loaded {len(existing):,} previously exported COG names from {args.skip_manifest}')
 
+    times = ds[time_c].values.astype('datetime64[s]')
+
+    jobs = []
+    manifest = []
+    skipped = 0
+
+    for var_name in ds.data_vars:
         da = ds[var_name]
 
-        for time in da[time_c]:
-            data = da.sel(time=time)
-            data = data.rio.write_crs("epsg:4326")
-            # TODO: For set_spatial_dims should I determine the dim name instead of using the coord name?
-            # data = data.rio.set_spatial_dims(x_dim=lon_c, y_dim=lat_c)
-            data = data.rename({lon_c: 'x', lat_c: 'y'})
-            dt = time.values.astype('datetime64[s]').item()
-            data.attrs = {k.upper(): v for k, v in data.attrs.items()}
+        for start, stop in _time_chunks(da, da[time_c].dims[0]):
+            indices = []
 
-            try:
-                latitude = data['y'].to_numpy()
+            for i in range(start, stop):
+                filename = _cog_filename(args.output, times[i].item(), var_name)
+                manifest.append(filename)
 
-                if latitude[1] - latitude[0] >= 0:
-                    print(f'Flipping latitude for {var_name}')
-                    data = data.isel({'y': slice(None, None, -1)})
-            except Exception as e:
-                print(f'Could not check latitude ordering for {var_name} due to {e}')
+                if filename in existing:
+                    skipped += 1
+                else:
+                    indices.append(i)
 
-            filename = f'{args.output}_{dt.strftime("%Y-%m-%dT%H%M%SZ")}_{var_name}.tif'
+            if len(indices) > 0:
+                jobs.append((var_name, indices))
 
-            out_path = os.path.join('output', filename)
+    if skipped > 0:
+        print(f'Skipping {skipped:,} COGs already present in the prior manifest')
 
-            print(f'Writing timestep {dt} to {out_path}')
+    n_steps = sum(len(indices) for _, indices in jobs)
+
+    written = 0
+    written_bytes = 0
+    export_start = time.perf_counter()
+
+    # With --output-s3, COGs are uploaded (and removed locally) while later ones are still being exported
+    uploader = Uploader(args.output_s3, credentials) if args.output_s3 is not None else None
+
+    def record(results):
+        nonlocal written, written_bytes
+
+        for out_path, size in results:
+            written += 1
+            written_bytes += size
+
+            if uploader is not None:
+                uploader.submit(out_path)
 
-            data.rio.to_raster(out_path, driver='COG', sharing=False, **DRIVER_KWARGS)
+        print(f'[{written:,}/{n_steps:,}] COGs written')
+
+    if args.pool_workers > 1:
+        print(f'Exporting {n_steps:,} COGs from {len(jobs):,} time chunks with {args.pool_workers} workers')
+
+        with ProcessPoolExecutor(
+                max_workers=args.pool_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_pool_worker,
+                initargs=(store, args, profiles)
+        ) as pool:
+            futures = [pool.submit(_export_time_chunk, *job) for job in jobs]
+
+            for future in as_completed(futures):
+                record(future.result())
+    else:
+        for job in jobs:
+            record(_export_time_chunk(*job))
+
+    elapsed = time.perf_counter() - export_start
+
+    print(f'Exported {written:,} COGs ({written_bytes / 1024 ** 2:,.1f} MiB) in {elapsed:,.2f}s: '
+          f'{written / max(elapsed, 1e-9):,.2f} files/s, {written_bytes / 1024 ** 2 / max(elapsed, 1e-9):,.1f} MiB/s')
+
+    manifest_path = os.path.join('output', f'{args.output}_manifest.json')
+
+    with open(manifest_path, 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+
+    print(f'Wrote manifest of {len(manifest):,} COGs to {manifest_path}')
+
+    if uploader is not None:
+        uploader.submit(manifest_path)
+        uploader.close()
 
 
 if __name__ == '__main__':
@@ -109,6 +339,13 @@ if __name__ == '__main__':
         help='Name of the longitude coordinate'
     )
 
+    parser.add_argument(
+        '--output-s3',
+        default=None,
+        help='S3 URL prefix to upload the COGs and manifest to as they are written. Uploads run concurrently with '
+             'the export (multipart for large files) and each local file is removed once uploaded'
+    )
+
     parser.add_argument(
         '-o', '--output',
         required=False,
@@ -116,12 +353,79 @@ if __name__ == '__main__':
         help='Output cog filename prefix'
     )
 
+    parser.add_argument(
+        '--variables',
+        required=False,
+        nargs='*',
+        default=None,
+        help='Variables to export. All variables are exported if not set'
+    )
+
+    parser.add_argument(
+        '--start',
+        type=pd.Timestamp,
+        default=None,
+        help='Earliest time step to export (inclusive)'
+    )
+
+    parser.add_argument(
+        '--end',
+        type=pd.Timestamp,
+        default=None,
+        help='Latest time step to export (inclusive)'
+    )
+
+    parser.add_argument(
+        '--bbox',
+        type=float,
+        nargs=4,
+        default=None,
+        metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+        help='Spatial subset to export'
+    )
+
+    parser.add_argument(
+        '--skip-manifest',
+        default=None,
+        help='Local path or S3 URL of a JSON list of previously exported COGs (e.g., the manifest written by a prior '
+             'run). COGs with the same name are not exported again'
+    )
+
+    parser.add_argument(
+        '--cog-profile',
+        default=None,
+        help='Name of a built-in COG preset (fast, small, web) or path to a YAML file of per-variable COG creation '
+             'profiles. GDAL defaults are used if not set'
+    )
+
+    parser.add_argument(
+        '--benchmark-profiles',
+        action='store_true',
+        help='Write the first time step of each variable with GDAL defaults and each built-in preset, print write '
+             'time and size, and exit without exporting'
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=parse_bytes,
+        default=parse_bytes('4GB'),
+        help='Memory budget for decoded time steps, shared by the export workers (default: 4GB). Each worker decodes '
+             'as many time steps of a zarr time chunk at once as fit in its share, and at least one'
+    )
+
+    add_execution_args(
+        parser,
+        pool_workers_help='Number of worker processes used to export COGs concurrently (default: 1). Each process '
+                          'uses --threads-per-worker threads for its dask computations'
+    )
+
     args = parser.parse_args()
 
     print(args)
 
     try:
-        main(args)
+        with execution_context(args):
+            main(args)
     finally:
         for sd in staging_dirs:
             try:
@@ -5,6 +5,7 @@ import os
 import shutil
 import sys
 import tempfile
+from typing import List, Optional, Tuple
 from urllib.parse import urlparse
 
 import boto3
@@ -12,11 +13,22 @@ import numpy as np
 import pandas as pd
 import xarray as xr
 import zarr
+from dask.utils import parse_bytes
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 
-from src.util import open_zarr, get_config
+from src.chunk_copy import concat_chunk_copy
+from src.chunk_plan import config_chunks
+from src.codec_config import (
+    benchmark_codecs, build_encoding, empty_chunk_report, load_codec_config, precision_report, source_fill_values,
+    stored_dtype
+)
+from src.execution import add_execution_args, execution_context
+from src.rechunk import rechunk_to_zarr
+from src.s3_output import describe_store, output_store, remove_store, store_exists, write_consolidated
+from src.time_norm import KEEP_POLICIES, normalize_time
+from src.util import OPEN_WORKERS, get_zarr_store, get_config, open_zarr_metadata, s3_client, subset_dataset
 
 staging_dirs = []
 
@@ -33,6 +45,81 @@ def __get_zarr_urls(args, client):
             return json.load(temp)
 
 
+def _has_range(entry: dict) -> bool:
+    return entry.get('start') is not None and entry.get('end') is not None
+
+
+def _probe_time_ranges(entries: List[dict], time_coord: str, credentials, workers: int) -> List[dict]:
+    # Fills in start/end (and the full time coordinate, when read) for every input. Ranges carried by the manifest are
+    # used as-is; otherwise only the consolidated metadata and time coordinate of the store are read
+    opened = open_zarr_metadata([e['url'] for e in entries if not _has_range(e)], credentials, workers)
+    probed = []
+
+    for entry in entries:
+        entry = dict(entry)
+
+        if _has_range(entry):
+            entry['start'] = np.datetime64(pd.Timestamp(entry['start']).to_datetime64(), 'ns')
+            entry['end'] = np.datetime64(pd.Timestamp(entry['end']).to_datetime64(), 'ns')
+        else:
+            ds = opened[entry['url']]
+            entry['ds'] = ds
+            times = ds[time_coord].to_numpy().astype('datetime64[ns]')
+
+            if len(times) == 0:
+                print(f'Dropping {entry["url"]}: no time steps')
+                continue
+
+            entry['times'] = times
+            entry['start'] = times.min()
+            entry['end'] = times.max()
+
+        probed.append(entry)
+
+    return probed
+
+
+def _prune_inputs(
+        entries: List[dict],
+        duration: Optional[pd.Timedelta],
+        keep: str = 'first'
+) -> Tuple[List[dict], Optional[np.datetime64]]:
+    cutoff = None
+    kept = entries
+
+    if duration is not None and len(entries) > 0:
+        cutoff = max(e['end'] for e in entries) - np.timedelta64(duration)
+        kept = [e for e in entries if e['end'] >= cutoff]
+
+        for e in entries:
+            if e['end'] < cutoff:
+                print(f'Dropping {e["url"]}: ends at {e["end"]}, before the retained window starting {cutoff}')
+
+    # Duplicate time steps keep the value from the earliest (or, with keep='last', latest) input in manifest order, so
+    # an input whose (retained) time steps all appear in inputs that take precedence over it contributes nothing
+    result = []
+    seen = np.array([], dtype='datetime64[ns]')
+
+    for e in (kept if keep == 'first' else reversed(kept)):
+        if 'times' in e:
+            times = e['times'] if cutoff is None else e['times'][e['times'] >= cutoff]
+
+            if np.isin(times, seen).all():
+                print(f'Dropping {e["url"]}: all of its time steps are shadowed by other inputs')
+                continue
+
+            seen = np.union1d(seen, times)
+
+        result.append(e)
+
+    if keep == 'last':
+        result.reverse()
+
+    print(f'Kept {len(result):,} of {len(entries):,} inputs after time pruning')
+
+    return result, cutoff
+
+
 def main(args):
     output = args.output
 
@@ -40,89 +127,124 @@ def main(args):
     dim = config['dimensions']['time']
 
     session = boto3.Session(profile_name=os.getenv('AWS_PROFILE', None))
-    client = session.client('s3')
+    client = s3_client(session)
 
-    datasets = []
-
-    for z_url in __get_zarr_urls(args, client):
-        credentials = session.get_credentials().get_frozen_credentials()
-        ds, stage_dir = open_zarr(z_url, args.zarr_access, client, credentials)
-
-        if stage_dir is not None:
-            staging_dirs.append(stage_dir)
+    time_coord = config['coordinates']['time']
+    credentials = session.get_credentials().get_frozen_credentials()
 
-        print(f'Opened zarr dataset at {z_url}')
+    entries = [e if isinstance(e, dict) else {'url': e} for e in __get_zarr_urls(args, client)]
+    entries, cutoff = _prune_inputs(
+        _probe_time_ranges(entries, time_coord, credentials, args.open_workers),
+        args.duration,
+        args.keep
+    )
 
-        datasets.append(ds)
+    if args.zarr_access == 'mount':
+        # Mounted inputs are used as opened by the probe; only those whose range came from the manifest still need
+        # their metadata
+        opened = open_zarr_metadata([e['url'] for e in entries if 'ds' not in e], credentials, args.open_workers)
 
-    print(f'Opened {len(datasets):,} zarr datasets')
+        for entry in entries:
+            entry.setdefault('ds', opened.get(entry['url']))
 
-    ds = xr.concat(datasets, dim=dim).sortby(dim)
+    datasets = []
+    stores = []
 
-    print('New dataset:')
-    print(ds)
+    for entry in entries:
+        z_url = entry['url']
 
-    time_coord = config['coordinates']['time']
+        # Inputs straddling the start of the retained window only need their chunks inside it
+        selection = {dim: (cutoff, None)} if cutoff is not None and entry['start'] < cutoff else None
 
-    # Dedup time steps
+        if args.zarr_access == 'mount':
+            store, _ = get_zarr_store(z_url, 'mount', client, credentials)
+            ds = entry['ds']
+        else:
+            store, stage_dir = get_zarr_store(z_url, args.zarr_access, client, credentials, selection=selection)
 
-    times = ds[time_coord].to_numpy()
+            if stage_dir is not None:
+                staging_dirs.append(stage_dir)
 
-    if any(np.diff(times).astype(int) == 0):
-        print(f'Warning: duplicate time steps detected')
+            ds = xr.open_zarr(store, consolidated=True)
 
-        prev = None
-        drop = []
+            print(f'Opened zarr dataset at {z_url}')
 
-        for i, v in enumerate(times.astype(int)):
-            if v == prev:
-                drop.append(i - 1)
+        ds = subset_dataset(ds, None, selection)
 
-            prev = v
+        datasets.append(ds)
+        stores.append(zarr.storage.DirectoryStore(store) if isinstance(store, str) else store)
 
-        print(f'Dropping {len(drop):,} time steps at indices: {drop}')
+    print(f'Opened {len(datasets):,} zarr datasets')
 
-        ds = ds.drop_duplicates(dim=dim, keep='first')
+    # The layout is planned from the input metadata, so the chunk-copy fast path can run before any concat graph is
+    # built
+    codecs = load_codec_config(config)
+    chunk_config = config_chunks(
+        config,
+        datasets[-1],
+        codecs,
+        {**datasets[-1].sizes, dim: sum(d.sizes[dim] for d in datasets)}
+    )
+    out_path = output_store(output, args.output_s3, credentials)
 
-    if args.duration is not None:
-        ds_duration = pd.Timedelta((ds[time_coord][-1] - ds[time_coord][0]).data.item())
+    if args.benchmark_codecs:
+        benchmark_codecs(datasets[-1], codecs, chunk_config)
+        return
 
-        print(f'new dataset duration: {ds_duration}')
+    if not args.no_chunk_copy:
+        if store_exists(out_path):
+            raise FileExistsError(f'Output zarr already exists: {describe_store(out_path)}')
 
-        if ds_duration > args.duration:
-            print('Dataset duration exceeds max duration provided')
+        copied = concat_chunk_copy(
+            stores,
+            zarr.storage.DirectoryStore(out_path) if isinstance(out_path, str) else out_path,
+            dim,
+            time_coord,
+            chunk_config,
+            {vname: codecs.zarray(vname, stored_dtype(da)) for vname, da in datasets[0].data_vars.items()},
+            args.duration
+        )
 
-            idx = 0
+        if copied:
+            print(f'Wrote zarr file by chunk copy: {describe_store(out_path)}')
+            empty_chunk_report(out_path)
+            return
 
-            while pd.Timedelta((ds[time_coord][-1] - ds[time_coord][idx]).data.item()) > args.duration:
-                idx += 1
+        remove_store(out_path)
 
-            ds = ds.isel(time=slice(idx, None))
+    ds = xr.concat(datasets, dim=dim)
 
-            print(f'Dropped {idx:,} time steps. New dataset duration: '
-                  f'{pd.Timedelta((ds[time_coord][-1] - ds[time_coord][0]).data.item())}')
+    print('New dataset:')
+    print(ds)
 
-    chunk_config = {config['dimensions'][d]: config['chunks'][d] for d in config['chunks']}
+    ds = normalize_time(ds, dim, time_coord, keep=args.keep, duration=args.duration)
 
     # exit()
 
     print(f'Setting chunk config: {chunk_config}')
 
-    for var in ds.data_vars:
-        ds[var] = ds[var].chunk(chunk_config)
+    encoding = build_encoding(codecs, ds, source_fill_values(ds))
 
-    compressor = zarr.Blosc(cname="blosclz", clevel=9)
-    encoding = {vname: {'compressor': compressor} for vname in ds.data_vars}
+    print(f'Writing to zarr file: {describe_store(out_path)}')
 
-    print(f'Writing to zarr file: {os.path.join("output", output)}')
+    if args.max_memory is not None:
+        rechunk_to_zarr(ds, chunk_config, out_path, encoding, args.max_memory, args.temp_dir)
+    else:
+        for var in ds.data_vars:
+            ds[var] = ds[var].chunk(chunk_config)
 
-    ds.to_zarr(
-        os.path.join('output', output),
-        mode='w-',
-        encoding=encoding,
-        consolidated=True,
-        write_empty_chunks=False
-    )
+        write_consolidated(
+            ds,
+            out_path,
+            mode='w-',
+            encoding=encoding,
+            write_empty_chunks=False
+        )
+
+    empty_chunk_report(out_path)
+
+    if len(codecs.precision) > 0:
+        precision_report(ds, out_path, encoding, codecs, chunk_config)
 
 
 if __name__ == '__main__':
@@ -145,7 +267,9 @@ if __name__ == '__main__':
 
     input_group.add_argument(
         '-m', '--zarr-manifest',
-        help='S3 URL to file containing a simple JSON list of zarr input URLs'
+        help='S3 URL to file containing a JSON list of zarr inputs. Each entry is either a URL or an object with a '
+             '"url" and optionally the "start" and "end" of its time range (ISO 8601); inputs with a range are '
+             'pruned without reading their metadata'
     )
 
     parser.add_argument(
@@ -156,6 +280,13 @@ if __name__ == '__main__':
         help='stage: Download zarr data from S3 to local filesystem; mount: mount S3 to local filesystem'
     )
 
+    parser.add_argument(
+        '--keep',
+        choices=KEEP_POLICIES,
+        default='first',
+        help='Which of a set of duplicate time steps to keep: the one from the first or last input. Default: first'
+    )
+
     parser.add_argument(
         '-d', '--duration',
         type=pd.Timedelta,
@@ -164,18 +295,62 @@ if __name__ == '__main__':
              'Duration (or anything else parseable by pandas.Timedelta)'
     )
 
+    parser.add_argument(
+        '--no-chunk-copy',
+        action='store_true',
+        help='Always decode and re-encode the inputs instead of copying compressed chunks when they are compatible'
+    )
+
+    parser.add_argument(
+        '--open-workers',
+        type=int,
+        default=OPEN_WORKERS,
+        help='Number of input stores whose metadata is opened concurrently (default: OPEN_WORKERS or 32)'
+    )
+
+    parser.add_argument(
+        '--benchmark-codecs',
+        action='store_true',
+        help='Sample a few chunks of the input, print the ratio and write/read throughput of the configured and '
+             'candidate codecs for each variable, and exit without writing'
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=parse_bytes,
+        default=None,
+        help='If set, write through a two-phase rechunk (see src/rechunk.py) whose tasks fit within this memory '
+             'budget (e.g., 8GB), instead of rechunking in a single dask graph'
+    )
+
+    parser.add_argument(
+        '--temp-dir',
+        default=None,
+        help='Directory for the intermediate store of --max-memory rechunks (default: the system temp directory)'
+    )
+
+    parser.add_argument(
+        '--output-s3',
+        default=None,
+        help='S3 URL prefix to write the output zarr store to directly, instead of the local output directory. '
+             'Chunks are uploaded as they are computed and the consolidated metadata is written last'
+    )
+
     parser.add_argument(
         '-o', '--output',
         required=True,
         help='Output zarr filename'
     )
 
+    add_execution_args(parser)
+
     args = parser.parse_args()
 
     print(args)
 
     try:
-        main(args)
+        with execution_context(args):
+            main(args)
     finally:
         for sd in staging_dirs:
             try: